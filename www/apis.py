@@ -9,7 +9,7 @@ class Page(object):
     Page object for display pages.
     '''
 
-    def __init__(self, item_count, page_index=1, page_size=10):
+    def __init__(self, item_count, page_index=1, page_size=10, after=None):
         '''
         Init Pagination by item_count, page_index and page_size.
         >>> p1 = Page(100, 1)
@@ -33,21 +33,63 @@ class Page(object):
         90
         >>> p3.limit
         10
+
+        Pass item_count=None to skip counting, or an after cursor to page by keyset.
+        One extra row is fetched and trim() uses it to decide has_next.
+        >>> p4 = Page(None, 3, 10)
+        >>> p4.offset
+        20
+        >>> p4.limit
+        11
+        >>> len(p4.trim(range(11)))
+        10
+        >>> p4.has_next
+        True
+        >>> p5 = Page(None, 4, 10, after='token')
+        >>> p5.offset
+        0
+        >>> p5.trim(range(3), lambda item: 'c%s' % item)
+        [0, 1, 2]
+        >>> p5.has_next, p5.next_cursor
+        (False, None)
         '''
         self.item_count = item_count
         self.page_size = page_size
-        self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
-        if (item_count == 0) or (page_index > self.page_count):
+        self.after = after
+        self.next_cursor = None
+        if item_count is None:
+            self.page_count = None
+        else:
+            self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
+        if (item_count is None) or (after is not None):
+            self.page_index = page_index
+            self.offset = 0 if after is not None else self.page_size * (page_index - 1)
+            self.limit = self.page_size + 1
+            self.has_next = False
+        elif (item_count == 0) or (page_index > self.page_count):
             self.offset = 0
             self.limit = 0
             self.page_index = 1
+            self.has_next = False
         else:
             self.page_index = page_index
             self.offset = self.page_size * (page_index - 1)
             self.limit = self.page_size
-        self.has_next = self.page_index < self.page_count
+            self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
 
+    def trim(self, items, cursor=None):
+        '''
+        Drop the extra row fetched without a count and set has_next, next_cursor.
+        '''
+        items = list(items)
+        if self.limit > self.page_size:
+            self.has_next = len(items) > self.page_size
+            items = items[:self.page_size]
+        if cursor is not None and self.has_next and items:
+            self.next_cursor = cursor(items[-1])
+        return items
+
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 
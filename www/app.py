@@ -9,7 +9,7 @@ from jinja2 import Environment, FileSystemLoader
 
 from config import configs
 
-import orm
+import orm, search
 from coroweb import add_routes, add_static
 
 from handlers import cookie2user, COOKIE_NAME
@@ -51,110 +51,118 @@ def init_jinja2(app, **kw):
     app['__templating__'] = env         # app是一个dict-like对象
 
 # 编写用于输出日志的middleware拦截器
-# handler是URL处理函数
+# handler是下一个拦截器或URL处理函数，用@web.middleware声明的拦截器每个请求直接调用，不用再为每个handler生成一层闭包
 # 有了此拦截器，URL处理函数处理哪个方法都在控制台一目了然
-@asyncio.coroutine
-def logger_factory(app, handler):
-    @asyncio.coroutine
-    def logger(request):
-        logging.info('Request: %s %s' % (request.method, request.path))
-        # await asyncio.sleep(0.3)
-        return (yield from handler(request))
-    return logger
-
-#在处理URL之前把cookie拦截，解析出来，绑定到request，后续URL处理函数在response_factory可以直接拿到登录用户
-@asyncio.coroutine
-def auth_factory(app, handler):
-    @asyncio.coroutine
-    def auth(request):
-        logging.info('check user: %s %s' % (request.method, request.path))
-        request.__user__ = None
-        cookie_str = request.cookies.get(COOKIE_NAME)
-        if cookie_str:
-            user = yield from cookie2user(cookie_str)
-            if user:
-                logging.info('set current user: %s' % user.email)
-                request.__user__ = user
-        if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
-            return web.HTTPFound('/signin')
-        return (yield from handler(request))
-    return auth
-
-@asyncio.coroutine
-def data_factory(app, handler):
-    @asyncio.coroutine
-    def parse_data(request):
-        if request.method == 'POST':
-            if request.content_type.startswith('application/json'):
-                request.__data__ = yield from request.json()
-                logging.info('request json: %s' % str(request.__data__))
-            elif request.content_type.startswith('application/x-www-form-urlencoded'):
-                request.__data__ = yield from request.post()
-                logging.info('request form: %s' % str(request.__data__))
-        return (yield from handler(request))
-    return parse_data
+@web.middleware
+async def logger_middleware(request, handler):
+    # 每个请求都执行的日志用参数形式，日志级别关闭时不用格式化字符串
+    logging.info('Request: %s %s', request.method, request.path)
+    return await handler(request)
+
+# 每个请求一个identity map，请求内按主键重复查询同一行时直接复用已加载的对象
+@web.middleware
+async def identity_middleware(request, handler):
+    token = orm.begin_identity_map()
+    try:
+        return await handler(request)
+    finally:
+        orm.end_identity_map(token)
+
+#在处理URL之前把cookie拦截，解析出来，绑定到request，后续URL处理函数在response_middleware可以直接拿到登录用户
+@web.middleware
+async def auth_middleware(request, handler):
+    logging.info('check user: %s %s', request.method, request.path)
+    request.__user__ = None
+    cookie_str = request.cookies.get(COOKIE_NAME)
+    if cookie_str:
+        user = await cookie2user(cookie_str)
+        if user:
+            logging.info('set current user: %s', user.email)
+            request.__user__ = user
+    if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
+        return web.HTTPFound('/signin')
+    # 按用户绑定数据库会话，用户写入后的一小段时间内读主库
+    token = orm.bind_session(request.__user__.id if request.__user__ else None)
+    try:
+        return await handler(request)
+    finally:
+        orm.unbind_session(token)
+
+@web.middleware
+async def data_middleware(request, handler):
+    if request.method == 'POST':
+        if request.content_type.startswith('application/json'):
+            request.__data__ = await request.json()
+            logging.info('request json: %s', request.__data__)
+        elif request.content_type.startswith('application/x-www-form-urlencoded'):
+            request.__data__ = await request.post()
+            logging.info('request form: %s', request.__data__)
+    return await handler(request)
+
+# 序列化JSON时处理不是dict的对象，紧凑的行对象用_asdict()转换
+def json_default(o):
+    if isinstance(o, orm.Row):
+        return o._asdict()
+    return o.__dict__
 
 # 这个拦截器处理URL处理函数返回值，在这里request最终被转换成response
-@asyncio.coroutine
-def response_factory(app, handler):
-    @asyncio.coroutine
-    def response(request):
-        logging.info('Response handler...')
-        # r是经过URL处理函数处理后的返回值
-        r = yield from handler(request)
-        # 如果r直接就是response对象，直接返回
-        # StreamResponse是所有Response对象的父类
-        if isinstance(r, web.StreamResponse):
-            return r
-        # 如果r是字节码对象
-        if isinstance(r, bytes):
-            # 字节码继承自StreamResponse，接受body参数，构造HTTP响应内容
-            resp = web.Response(body=r)
-            # Response的content_type属性
-            resp.content_type = 'application/octet-stream'
+@web.middleware
+async def response_middleware(request, handler):
+    logging.info('Response handler...')
+    # r是经过URL处理函数处理后的返回值
+    r = await handler(request)
+    # 如果r直接就是response对象，直接返回
+    # StreamResponse是所有Response对象的父类
+    if isinstance(r, web.StreamResponse):
+        return r
+    # 如果r是字节码对象
+    if isinstance(r, bytes):
+        # 字节码继承自StreamResponse，接受body参数，构造HTTP响应内容
+        resp = web.Response(body=r)
+        # Response的content_type属性
+        resp.content_type = 'application/octet-stream'
+        return resp
+    # 如果r是string对象
+    if isinstance(r, str):
+        # 若r以返回重定向字符串开头
+        if r.startswith('redirect:'):
+            # 重定向至目标URL
+            return web.HTTPFound(r[9:])
+        # 同上，构造HTTP相应内容
+        resp = web.Response(body=r.encode('utf-8'))
+        # utf-8编码的text格式
+        resp.content_type = 'text/html;charset=utf-8'
+        return resp
+    # r为dict对象时
+    if isinstance(r, dict):
+        # 在后续构造URL处理函数返回值时，会加入__template__值，用以选择渲染的模板
+        template = r.get('__template__')
+        # 不带模板信息，返回json对象
+        if template is None:
+            resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
+            resp.content_type = 'application/json;charset=utf-8'
             return resp
-        # 如果r是string对象
-        if isinstance(r, str):
-            # 若r以返回重定向字符串开头
-            if r.startswith('redirect:'):
-                # 重定向至目标URL
-                return web.HTTPFound(r[9:])
-            # 同上，构造HTTP相应内容
-            resp = web.Response(body=r.encode('utf-8'))
-            # utf-8编码的text格式
+        # 带模板信息，渲染模板
+        else:
+            # 在此拿到绑定到request的用户
+            r['__user__'] = request.__user__
+            resp = web.Response(body=request.app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+            # utf-8编码的html格式
             resp.content_type = 'text/html;charset=utf-8'
             return resp
-        # r为dict对象时
-        if isinstance(r, dict):
-            # 在后续构造URL处理函数返回值时，会加入__template__值，用以选择渲染的模板
-            template = r.get('__template__')
-            # 不带模板信息，返回json对象
-            if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
-                resp.content_type = 'application/json;charset=utf-8'
-                return resp
-            # 带模板信息，渲染模板
-            else:
-                # 在此拿到绑定到request的用户
-                r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
-                # utf-8编码的html格式
-                resp.content_type = 'text/html;charset=utf-8'
-                return resp
-        # 返回响应码
-        if isinstance(r, int) and r >= 100 and r < 600:
-            return web.Response(r)
-        # 返回了一组响应代码和原因，如：(200, 'OK'), (404, 'Not Found')
-        if isinstance(r, tuple) and len(r) == 2:
-            t, m = r
-            if isinstance(t, int) and t >= 100 and t < 600:
-                return web.Response(t, str(m))
-        # 均以上条件不满足，默认返回
-        resp = web.Response(body=str(r).encode('utf-8'))
-        # utf-8纯文本
-        resp.content_type = 'text/plain;charset=utf-8'
-        return resp
-    return response
+    # 返回响应码
+    if isinstance(r, int) and r >= 100 and r < 600:
+        return web.Response(status=r)
+    # 返回了一组响应代码和原因，如：(200, 'OK'), (404, 'Not Found')
+    if isinstance(r, tuple) and len(r) == 2:
+        t, m = r
+        if isinstance(t, int) and t >= 100 and t < 600:
+            return web.Response(status=t, reason=str(m))
+    # 均以上条件不满足，默认返回
+    resp = web.Response(body=str(r).encode('utf-8'))
+    # utf-8纯文本
+    resp.content_type = 'text/plain;charset=utf-8'
+    return resp
 
 # 日期过滤器，数据库中定义的日期不是标准格式，这里要转换一下
 def datetime_filter(t):
@@ -172,25 +180,47 @@ def datetime_filter(t):
 
 
 #初始化服务器
-@asyncio.coroutine
-def init(loop):
+# 关闭服务前把写入队列里的行写完，保存搜索索引
+async def on_shutdown(app):
+    await orm.flush_write_queues()
+    await search.save_index()
+
+# 拦截器按顺序执行，response_middleware最靠近URL处理函数
+MIDDLEWARES = [logger_middleware, identity_middleware, auth_middleware, response_middleware]
+
+async def init(loop):
     # 创建数据库连接池
     # await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='root', password='admin', db='blog')
-    yield from orm.create_pool(loop=loop, **configs.db)
+    orm.configure_tracing(**configs.trace)
+    await orm.create_pool(loop=loop, **configs.db)
+    # 统计各表行数，列表页的count直接读计数器，并定期和数据库核对
+    await orm.init_counters()
+    orm.start_counter_reconciler()
+    # 加载全文搜索索引，修改过的索引定期保存
+    await search.init_index(configs.search.path)
+    search.start_index_saver(configs.search.interval)
+    orm.start_archiver(configs.archive.interval)
     # 创建一个Application实例，加入拦截器
-    app = web.Application(loop=loop, middlewares=[logger_factory, auth_factory, response_factory])
+    app = web.Application(middlewares=MIDDLEWARES)
+    app.on_shutdown.append(on_shutdown)
     # 初始化jinjia2模板
     init_jinja2(app, filters=dict(datetime=datetime_filter))
     # 注册url处理函数，在handlers.py中定义映射路径
     add_routes(app, 'handlers')
     # 添加静态文件
     add_static(app)
-    # 创建服务器，绑定地址，端口和handler
-    srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
+    # 创建服务器，绑定地址和端口
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 9000).start()
     logging.info('server started at http://127.0.0.1:9000...')
-    return srv
-
-loop = asyncio.get_event_loop() #获取EventLoop
-loop.run_until_complete(init(loop)) #用loop执行协程初始化服务器
-loop.run_forever() #用loop控制服务器不关闭
-
+    return runner
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop() #获取EventLoop
+    runner = loop.run_until_complete(init(loop)) #用loop执行协程初始化服务器
+    try:
+        loop.run_forever() #用loop控制服务器不关闭
+    finally:
+        # cleanup会调用on_shutdown
+        loop.run_until_complete(runner.cleanup())
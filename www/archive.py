@@ -0,0 +1,32 @@
+'''
+Move old rows of the models that declare __archive__ to their archive tables.
+
+    python archive.py              archive the rows older than each model's age
+    python archive.py --compact    also compact the archive tables afterwards
+
+The app archives in the background every configs.archive.interval seconds,
+this script does the same once, for example before a backup.
+'''
+
+import sys, asyncio, logging
+
+import orm
+from config import configs
+from models import User, Blog, Comment
+
+MODELS = (User, Blog, Comment)
+
+async def main(argv):
+    await orm.create_pool(loop=None, **configs.db)
+    for cls in MODELS:
+        if cls.__archive__ is None:
+            continue
+        moved = await orm.archive_rows(cls)
+        logging.info('%s: %s rows moved to %s.' % (cls.__table__, moved, cls.__archive__.table))
+        if '--compact' in argv:
+            await orm.compact_archive(cls)
+            logging.info('%s compacted.' % cls.__archive__.table)
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(sys.argv[1:]))
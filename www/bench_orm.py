@@ -0,0 +1,175 @@
+'''
+Microbenchmarks for the ORM's own overhead, run against the in-memory SQLite backend.
+
+    python bench_orm.py                      run all benchmarks and print the results as JSON
+    python bench_orm.py -k hydrate           run only benchmarks whose name contains "hydrate"
+    python bench_orm.py -o bench.json        also write the results to bench.json
+    python bench_orm.py --compare old.json   print the change of each benchmark against an earlier run
+
+Every benchmark uses the same fixed data, and reports the best and median
+time per operation over several repeats.
+'''
+
+import sys, os, json, time, timeit, asyncio, logging, platform, argparse, subprocess, statistics
+
+# orm的info日志会干扰计时，要在导入orm之前配置
+logging.basicConfig(level=logging.WARNING)
+
+import orm
+from orm import Model, ModelMetaclass, StringField, BooleanField, FloatField, TextField
+from models import Blog
+
+ROWS = 100
+REPEAT = 5
+
+# 没有写出的列用字段的默认值，Blog以后加了列也不用改这里
+def make_rows(n):
+    rows = []
+    for i in range(n):
+        row = dict((k, f.default() if callable(f.default) else f.default) for k, f in Blog.__mappings__.items())
+        row.update(id='%015d%032d000' % (1500000000000 + i, i), user_id='%050d' % (i % 7),
+                   user_name='user %d' % (i % 7), user_image='http://www.gravatar.com/avatar/%d' % (i % 7),
+                   name='blog %d' % i, summary='summary of blog %d ' % i * 3, content='content %d ' % i * 200,
+                   created_at=1500000000.0 + i)
+        rows.append(row)
+    return rows
+
+_benchmarks = []
+
+# 注册一个benchmark，setup返回要计时的无参函数，ops为每次调用包含的操作数
+def bench(name, ops=1):
+    def decorator(setup):
+        _benchmarks.append((name, ops, setup))
+        return setup
+    return decorator
+
+@bench('build_select.plain')
+def build_select_plain():
+    return lambda: Blog.buildSelect(None, None)
+
+@bench('build_select.where_order_limit')
+def build_select_where_order_limit():
+    return lambda: Blog.buildSelect('user_id=?', ['u'], orderBy='created_at desc', limit=(10, 10))
+
+@bench('build_select.cursor_fields')
+def build_select_cursor_fields():
+    after = orm.encode_cursor((1500000000.0, 'x'))
+    return lambda: Blog.buildSelect(None, None, after=after, limit=10, fields=('name', 'summary'))
+
+@bench('metaclass.create_class')
+def metaclass_create_class():
+    def create():
+        ModelMetaclass('BenchModel', (Model,), dict(
+            __table__='bench', __indexes__=[('user_id', 'created_at')],
+            id=StringField(primary_key=True, ddl='varchar(50)'), user_id=StringField(ddl='varchar(50)'),
+            name=StringField(ddl='varchar(50)', index=True), admin=BooleanField(),
+            content=TextField(deferred=True), created_at=FloatField(default=time.time)))
+    return create
+
+@bench('hydrate.model', ops=ROWS)
+def hydrate_model():
+    rows = make_rows(ROWS)
+    return lambda: [Blog(**r) for r in rows]
+
+@bench('hydrate.from_row', ops=ROWS)
+def hydrate_from_row():
+    rows = make_rows(ROWS)
+    return lambda: [Blog.fromRow(r) for r in rows]
+
+@bench('hydrate.compact_row', ops=ROWS)
+def hydrate_compact_row():
+    columns = Blog.columnsOf(None, True)
+    rs = [tuple(r[c] for c in columns) for r in make_rows(ROWS)]
+    return lambda: Blog.__row__.hydrate(columns, rs)
+
+@bench('save.args', ops=ROWS)
+def save_args():
+    objs = [Blog(**r) for r in make_rows(ROWS)]
+    def assemble():
+        for obj in objs:
+            args = list(map(obj.getValueOrDefault, obj.__fields__))
+            args.append(obj.getValueOrDefault(obj.__primary_key__))
+    return assemble
+
+@bench('save.args_defaults', ops=ROWS)
+def save_args_defaults():
+    rows = make_rows(ROWS)
+    for r in rows:
+        del r['id'], r['created_at']
+    def assemble():
+        for r in rows:
+            obj = Blog(**r)
+            args = list(map(obj.getValueOrDefault, obj.__fields__))
+            args.append(obj.getValueOrDefault(obj.__primary_key__))
+    return assemble
+
+@bench('json.models', ops=ROWS)
+def json_models():
+    objs = [Blog(**r) for r in make_rows(ROWS)]
+    return lambda: json.dumps(objs, ensure_ascii=False)
+
+@bench('json.compact_rows', ops=ROWS)
+def json_compact_rows():
+    columns = Blog.columnsOf(None, True)
+    rows = Blog.__row__.hydrate(columns, [tuple(r[c] for c in columns) for r in make_rows(ROWS)])
+    return lambda: json.dumps(rows, ensure_ascii=False, default=lambda o: o._asdict())
+
+@bench('find_all.sqlite', ops=ROWS)
+def find_all_sqlite():
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(orm.create_pool(loop, backend='sqlite', db=':memory:', maxsize=1,
+        schema=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')))
+    loop.run_until_complete(Blog.save_many(make_rows(ROWS)))
+    return lambda: loop.run_until_complete(Blog.findAll(orderBy='created_at desc', limit=ROWS))
+
+# 计时一个benchmark，返回每次操作的纳秒数
+def measure(ops, fn, repeat=REPEAT):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    times = [t / number / ops * 1e9 for t in timer.repeat(repeat, number)]
+    return dict(ns_per_op=round(min(times), 1), median_ns=round(statistics.median(times), 1),
+                ops=ops, loops=number, repeat=repeat)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(pattern=None, repeat=REPEAT):
+    results = {}
+    for name, ops, setup in _benchmarks:
+        if pattern and pattern not in name:
+            continue
+        results[name] = measure(ops, setup(), repeat)
+        print('%-32s %12.1f ns/op' % (name, results[name]['ns_per_op']), file=sys.stderr)
+    return dict(revision=git_revision(), python=platform.python_version(), rows=ROWS, results=results)
+
+# 和之前的结果比较，ratio大于1表示变慢
+def compare(old, new):
+    diff = {}
+    for name, r in new['results'].items():
+        if name in old['results']:
+            before = old['results'][name]['ns_per_op']
+            diff[name] = dict(before=before, after=r['ns_per_op'], ratio=round(r['ns_per_op'] / before, 3))
+    return dict(before=old.get('revision'), after=new.get('revision'), results=diff)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Microbenchmarks for orm.py.')
+    parser.add_argument('-k', dest='pattern', help='only run benchmarks whose name contains PATTERN')
+    parser.add_argument('-o', dest='output', help='write the results to this file')
+    parser.add_argument('-r', dest='repeat', type=int, default=REPEAT, help='number of repeats')
+    parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    opts = parser.parse_args(argv)
+    result = run(opts.pattern, opts.repeat)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if opts.compare:
+        with open(opts.compare) as f:
+            result = compare(json.load(f), result)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,131 @@
+'''
+Microbenchmarks for the per-request overhead of the middleware chain and RequestHandler.
+
+    python bench_web.py                      run all benchmarks and print the results as JSON
+    python bench_web.py -k native            run only benchmarks whose name contains "native"
+    python bench_web.py -o bench.json        also write the results to bench.json
+    python bench_web.py --compare old.json   print the change of each benchmark against an earlier run
+
+Requests are mocked and passed straight through the middlewares in app.py, so
+no socket or database is involved. The legacy benchmarks rebuild the old
+generator-based middleware factories and the asyncio.coroutine shim with
+types.coroutine, which gives the before/after numbers on Pythons that no
+longer have asyncio.coroutine.
+'''
+
+import sys, json, types, inspect, asyncio, logging, argparse, functools, platform
+
+# app和orm的info日志会干扰计时，要在导入之前配置
+logging.basicConfig(level=logging.WARNING)
+
+from aiohttp.test_utils import make_mocked_request
+from aiohttp import web
+
+import app
+from coroweb import RequestHandler
+from bench_orm import measure, compare, git_revision, REPEAT
+
+REQUESTS = 100
+
+def sync_handler(*, page='1'):
+    return dict(page=page)
+
+async def async_handler(*, page='1'):
+    return dict(page=page)
+
+# 和已经删除的asyncio.coroutine相同：生成器函数直接标记为协程，普通函数包一层生成器
+def legacy_coroutine(fn):
+    if inspect.isgeneratorfunction(fn):
+        return types.coroutine(fn)
+    @functools.wraps(fn)
+    @types.coroutine
+    def coro(*args, **kw):
+        res = fn(*args, **kw)
+        if inspect.isawaitable(res):
+            res = yield from res.__await__()
+        return res
+    return coro
+
+# 原来app.py里的拦截器工厂，每个handler生成一层基于生成器的闭包
+def legacy_middleware(middleware):
+    @legacy_coroutine
+    def factory(app, handler):
+        @legacy_coroutine
+        def wrapper(request):
+            return (yield from middleware(request, handler).__await__())
+        return wrapper
+    return factory
+
+def native_chain(application, fn):
+    handler = RequestHandler(application, fn).__call__
+    # 和aiohttp一样从里到外把拦截器绑定到下一层handler上
+    for middleware in reversed(app.MIDDLEWARES):
+        handler = functools.partial(middleware, handler=handler)
+    return handler
+
+def legacy_chain(application, fn):
+    # 原来的add_route把普通函数包装成协程，RequestHandler.__call__也是基于生成器的协程
+    request_handler = RequestHandler(application, legacy_coroutine(fn))
+    request_handler._is_coroutine = True
+    handler = legacy_coroutine(request_handler.__call__)
+    loop = asyncio.get_event_loop()
+    for middleware in reversed(app.MIDDLEWARES):
+        handler = loop.run_until_complete(legacy_middleware(middleware)(application, handler))
+    return handler
+
+_benchmarks = []
+
+def bench(name, chain, fn):
+    _benchmarks.append((name, chain, fn))
+
+bench('request.legacy.sync_handler', legacy_chain, sync_handler)
+bench('request.native.sync_handler', native_chain, sync_handler)
+bench('request.legacy.async_handler', legacy_chain, async_handler)
+bench('request.native.async_handler', native_chain, async_handler)
+
+# 返回每次调用处理REQUESTS个请求的函数
+def setup(chain, fn):
+    loop = asyncio.get_event_loop()
+    application = web.Application()
+    request = make_mocked_request('GET', '/api/bench?page=2', app=application)
+    handler = chain(application, fn)
+    async def run():
+        for _ in range(REQUESTS):
+            resp = await handler(request)
+        assert resp.status == 200, resp.status
+    return lambda: loop.run_until_complete(run())
+
+def run(pattern=None, repeat=REPEAT):
+    results = {}
+    for name, chain, fn in _benchmarks:
+        if pattern and pattern not in name:
+            continue
+        results[name] = measure(REQUESTS, setup(chain, fn), repeat)
+        print('%-32s %12.1f ns/op' % (name, results[name]['ns_per_op']), file=sys.stderr)
+    # native相对legacy的耗时比例，小于1表示变快
+    speedup = {}
+    for kind in ('sync_handler', 'async_handler'):
+        legacy, native = results.get('request.legacy.%s' % kind), results.get('request.native.%s' % kind)
+        if legacy and native:
+            speedup[kind] = round(native['ns_per_op'] / legacy['ns_per_op'], 3)
+    return dict(revision=git_revision(), python=platform.python_version(), requests=REQUESTS,
+                results=results, native_vs_legacy=speedup)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Per-request overhead of app.py middlewares.')
+    parser.add_argument('-k', dest='pattern', help='only run benchmarks whose name contains PATTERN')
+    parser.add_argument('-o', dest='output', help='write the results to this file')
+    parser.add_argument('-r', dest='repeat', type=int, default=REPEAT, help='number of repeats')
+    parser.add_argument('--compare', help='results file of an earlier run to compare against')
+    opts = parser.parse_args(argv)
+    result = run(opts.pattern, opts.repeat)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if opts.compare:
+        with open(opts.compare) as f:
+            result = compare(json.load(f), result)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,11 +1,41 @@
 configs = {
     'debug': True,
     'db': {
+        # 数据库后端，mysql或sqlite，sqlite时db为文件路径或':memory:'，schema为建表sql文件
+        'backend': 'mysql',
+        'schema': None,
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'root',
         'password': 'admin',
-        'db': 'blog'
+        'db': 'blog',
+        # 只读副本，例如[{'host': '10.0.0.2'}]，其余配置和主库相同
+        'replicas': [],
+        # 写入后同一用户继续读主库的秒数
+        'sticky': 5
+    },
+    # SQL跟踪：sample为记录普通语句的比例，slow为慢查询的秒数，explain为是否记录慢查询的执行计划
+    # explain_interval为同一条语句两次explain之间至少间隔的秒数
+    'trace': {
+        'sample': 1.0,
+        'slow': 0.5,
+        'explain': True,
+        'explain_interval': 600
+    },
+    # 主键生成方式：legacy为50位的字符串，snowflake为按时间递增的整数，多个进程时每个进程的worker要不同
+    # 已有数据的库改用snowflake前先执行migrate_ids.py
+    'ids': {
+        'generator': 'legacy',
+        'worker': 0
+    },
+    # 博客全文搜索的索引文件，interval为后台保存的间隔秒数
+    'search': {
+        'path': 'search.idx',
+        'interval': 60
+    },
+    # 旧数据归档，interval为后台归档的间隔秒数
+    'archive': {
+        'interval': 3600
     },
     'session': {
         'secret': 'Awesome'
@@ -1,4 +1,4 @@
-import asyncio, os, inspect, logging, functools
+import asyncio, os, inspect, logging
 
 from urllib import parse
 
@@ -7,26 +7,21 @@ from aiohttp import web
 from apis import APIError
 
 # 定义装饰器，从用户输入的URL获得HTTP请求是get还是post方法
+# 直接在函数上记录方法和路径，不再包一层wrapper，async def的处理函数仍然能被识别为协程函数
 def get(path):
     # Define decorator @get('/path')
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kw):
-            return func(*args, **kw)
-        wrapper.__method__ = 'GET'
-        wrapper.__route__ = path
-        return wrapper
+        func.__method__ = 'GET'
+        func.__route__ = path
+        return func
     return decorator
 
 def post(path):
     # Define decorator @post('/path')
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kw):
-            return func(*args, **kw)
-        wrapper.__method__ = 'POST'
-        wrapper.__route__ = path
-        return wrapper
+        func.__method__ = 'POST'
+        func.__route__ = path
+        return func
     return decorator
 
 # 用inspect方法分析URL处理函数中的参数，之后从request中提取，转换为response
@@ -92,9 +87,10 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
+        # async def的处理函数await调用，普通函数直接调用，不再包装成协程
+        self._is_coroutine = asyncio.iscoroutinefunction(fn)
 
-    @asyncio.coroutine
-    def __call__(self, request):
+    async def __call__(self, request):
         # 定义kw，用于保存request中参数
         kw = None
         # 若URL处理函数有命名关键词或关键词参数
@@ -104,27 +100,27 @@ class RequestHandler(object):
                 # 根据request参数中的content_type字段，确定不同的解析方法
                 if not request.content_type:
                     # 如果content_type不存在，返回400错误
-                    return web.HTTPBadRequest('Missing Content-Type.')
+                    return web.HTTPBadRequest(text='Missing Content-Type.')
                 # 将字段转换成小写，便于检查
                 ct = request.content_type.lower()
                 # 如果contenttype字段以json格式数据开头
                 if ct.startswith('application/json'):
                     # 保存json数据，request.json()返回dict对象
-                    params = yield from request.json()
+                    params = await request.json()
                     # 如果不是dict，报错
                     if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
+                        return web.HTTPBadRequest(text='JSON body must be object.')
                     # 保存request中的参数
                     kw = params
                 # 如果contenttype字段以form表单请求的编码形式开头
                 elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
                     # 保存post数据，dict-like对象。
-                    params = yield from request.post()
+                    params = await request.post()
                     # 组成dict，统一kw格式
                     kw = dict(**params)
                 else:
                     # 否则报错，contenttype存在，但是不支持的格式
-                    return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
+                    return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
             # 如果用户调用的是GET方法
             if request.method == 'GET':
                 # 返回URL查询语句，?后的键值。string形式。
@@ -166,13 +162,14 @@ class RequestHandler(object):
             for name in self._required_kw_args:
                 # 若kw中没有保存到参数值，报错。
                 if not name in kw:
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
+                    return web.HTTPBadRequest(text='Missing argument: %s' % name)
         # 至此，kw为URL处理函数fn真正能调用的参数
         # request请求中的参数，终于全部传递给了URL处理函数
-        logging.info('call with args: %s' % str(kw))
+        logging.info('call with args: %s', kw)
         try:
-            r = yield from self._func(**kw)
-            return r
+            if self._is_coroutine:
+                return await self._func(**kw)
+            return self._func(**kw)
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
 
@@ -193,14 +190,14 @@ def add_route(app, fn):
     # 如果没有获取到这俩关键的参数就报错
     if path is None or method is None:
         raise ValueError('@get or @post not defined in %s.' % str(fn))
-    # 判断URL处理函数是否协程并且是生成器
-    if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-        # 将URL处理函数转变成协程
-        fn = asyncio.coroutine(fn)
+    # 基于生成器的协程在Python 3.11上已经不能用了，要改成async def
+    if inspect.isgeneratorfunction(fn):
+        raise ValueError('generator-based handler %s is not supported, use async def.' % fn.__name__)
     logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
     # 在app中注册经RequestHandler类封装的URL处理函数
     # 这样app的路由就和URL处理函数连接起来了，在前台输入相应的path就能进行解析
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    # 注册绑定的async方法，aiohttp会把它当作协程函数直接await，不会再包一层检查返回值类型的wrapper
+    app.router.add_route(method, path, RequestHandler(app, fn).__call__)
 
 # 批量注册
 def add_routes(app, module_name):
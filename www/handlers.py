@@ -1,9 +1,11 @@
-import re, time, json, logging, hashlib, base64, asyncio
+import re, time, json, logging, hashlib, base64
 import markdown2
 from aiohttp import web
 from coroweb import get, post
 from apis import Page, APIValueError, APIResourceNotFoundError, APIError, APIPermissionError
 from models import User, Comment, Blog, next_id
+from orm import decode_cursor, gather_queries, create_args_string, mark_written, bind_session, unbind_session
+import search
 from config import configs
 
 
@@ -24,6 +26,31 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# 检查after游标和model的排序列对得上，错误的游标返回参数错误而不是在查询时出错
+def get_page_cursor(model, cursor_str):
+    if not cursor_str:
+        return None
+    try:
+        decode_cursor(cursor_str, len(model.__cursor__))
+    except ValueError:
+        raise APIValueError('after', 'Invalid cursor.')
+    return cursor_str
+
+# 分页查询，带after游标时按游标翻页，不再统计总数，列表只读所以用紧凑的行对象
+# 统计总数和查询当前页并发执行，页码超出范围时Page的limit为0，丢弃查到的结果
+async def load_page(model, page_index, after=None, page_size=10):
+    if after is not None:
+        p = Page(None, page_index, page_size, after=after)
+        items = await model.findAll(after=after, limit=(p.offset, p.limit), compact=True)
+        return p, p.trim(items, model.cursorOf)
+    num, items = await gather_queries(
+        model.findNumber('count(id)'),
+        model.findAll(after=None, limit=(page_size * (page_index - 1), page_size), compact=True))
+    p = Page(num, page_index, page_size)
+    if p.limit == 0:
+        return p, []
+    return p, p.trim(items, model.cursorOf)
+
 
 # 计算加密cookie，服务器生成cookie发送给浏览器，当浏览器再发回去时，进行比较，hash不相等就是伪造的
 def user2cookie(user, max_age):
@@ -33,16 +60,19 @@ def user2cookie(user, max_age):
     # build cookie string by: id-expires-sha1
     expires = str(int(time.time() + max_age))
     s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY)
-    L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
+    L = [str(user.id), expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
     return '-'.join(L)
 
+# 密码用注册时的用户id加盐，整数id迁移前注册的用户用原来的字符串id
+def passwd_salt(user):
+    return user.get('legacy_id', None) or str(user.id)
+
 def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
     return ''.join(lines)
 
 # 解密cookie
-@asyncio.coroutine
-def cookie2user(cookie_str):
+async def cookie2user(cookie_str):
     '''
     Parse cookie and load user if cookie is valid.
     '''
@@ -55,13 +85,20 @@ def cookie2user(cookie_str):
         uid, expires, sha1 = L
         if int(expires) < time.time():
             return None
-        user = yield from User.find(uid)
+        # 按cookie里的用户绑定会话再查，刚注册或刚写过数据的用户从主库读
+        token = bind_session(User.castPk(uid))
+        try:
+            user = await User.find_batched(uid)
+        finally:
+            unbind_session(token)
         if user is None:
             return None
         s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('invalid sha1')
             return None
+        # 复制一份再隐藏密码，identity map里的对象保持和数据库一致
+        user = User(**user)
         user.passwd = '******'
         return user
     except Exception as e:
@@ -70,15 +107,8 @@ def cookie2user(cookie_str):
 
 
 @get('/')
-@asyncio.coroutine
-def index(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
-    page = Page(num, page_index)
-    if num == 0:
-        blogs = []
-    else:
-        blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+async def index(*, page='1', after=None):
+    page, blogs = await load_page(Blog, get_page_index(page), get_page_cursor(Blog, after))
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -86,10 +116,12 @@ def index(*, page='1'):
     }
 
 @get('/blog/{id}')
-@asyncio.coroutine
-def get_blog(id):
-    blog = yield from Blog.find(id)
-    comments = yield from Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+async def get_blog(id):
+    # 评论不会早于博客，先查博客再用博客的发布时间限定评论的范围，新博客的评论不用查归档表
+    blog = await Blog.find(id)
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc', since=blog.created_at)
     for c in comments:
         c.html_content = text2html(c.content)
     blog.html_content = markdown2.markdown(blog.content)
@@ -113,19 +145,17 @@ def signin():
 
 # 实现登录API
 @post('/api/authenticate')
-@asyncio.coroutine
-def authenticate(*, email, passwd):
+async def authenticate(*, email, passwd):
     if not email:
         raise APIValueError('email', 'Invalid email.')
     if not passwd:
         raise APIValueError('passwd', 'Invalid password.')
-    users = yield from User.findAll('email=?', [email])
-    if len(users) == 0:
+    user = await User.find_one('email=?', [email])
+    if user is None:
         raise APIValueError('email', 'Email not exist.')
-    user = users[0]
     # check passwd:
     sha1 = hashlib.sha1()
-    sha1.update(user.id.encode('utf-8'))
+    sha1.update(passwd_salt(user).encode('utf-8'))
     sha1.update(b':')
     sha1.update(passwd.encode('utf-8'))
     if user.passwd != sha1.hexdigest():
@@ -188,50 +218,37 @@ def manage_users(*, page='1'):
     }
 
 @get('/api/comments')
-@asyncio.coroutine
-def api_comments(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from Comment.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, comments=())
-    comments = yield from Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_comments(*, page='1', after=None):
+    p, comments = await load_page(Comment, get_page_index(page), get_page_cursor(Comment, after))
     return dict(page=p, comments=comments)
 
 @post('/api/blogs/{id}/comments')
-@asyncio.coroutine
-def api_create_comment(id, request, *, content):
+async def api_create_comment(id, request, *, content):
     user = request.__user__
     if user is None:
         raise APIPermissionError('Please signin first.')
     if not content or not content.strip():
         raise APIValueError('content')
-    blog = yield from Blog.find(id)
+    blog = await Blog.find(id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    yield from comment.save()
+    # 评论进写入队列和其他评论合并插入，等写入数据库后再返回
+    await (await comment.enqueue())
     return comment
 
 @post('/api/comments/{id}/delete')
-@asyncio.coroutine
-def api_delete_comments(id, request):
+async def api_delete_comments(id, request):
     check_admin(request)
-    c = yield from Comment.find(id)
+    c = await Comment.find(id)
     if c is None:
         raise APIResourceNotFoundError('Comment')
-    yield from c.remove()
+    await c.remove()
     return dict(id=id)
 
 @get('/api/users')
-@asyncio.coroutine
-def api_get_users(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from User.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, users=())
-    users = yield from User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_get_users(*, page='1', after=None):
+    p, users = await load_page(User, get_page_index(page), get_page_cursor(User, after))
     for u in users:
         u.passwd = '******'
     return dict(page=p, users=users)
@@ -240,21 +257,22 @@ def api_get_users(*, page='1'):
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 @post('/api/users')
-@asyncio.coroutine
-def api_register_user(*, email, name, passwd):
+async def api_register_user(*, email, name, passwd):
     if not name or not name.strip():
         raise APIValueError('name')
     if not email or not _RE_EMAIL.match(email):
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
-    users = yield from User.findAll('email=?', [email])
-    if len(users) > 0:
-        raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()
     sha1_passwd = '%s:%s' % (uid, passwd)
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
-    yield from user.save()
+    # email上有唯一索引，已经注册过的email插入不了；不用insert ignore，超长的name、email照常报错
+    rows = await user.insert_unique()
+    if rows == 0:
+        raise APIError('register:failed', 'email', 'Email is already in use.')
+    # 注册时还没有登录的会话，按新用户的id标记，下一个请求cookie2user读主库，不会因为副本落后而看不到这个用户
+    mark_written(user.id)
     # make session cookie:
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
@@ -265,27 +283,39 @@ def api_register_user(*, email, name, passwd):
 
 # 显示博客目录
 @get('/api/blogs')
-@asyncio.coroutine
-def api_blogs(*, page='1'):
-    page_index = get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_blogs(*, page='1', after=None):
+    p, blogs = await load_page(Blog, get_page_index(page), get_page_cursor(Blog, after))
     return dict(page=p, blogs=blogs)
 
+# 搜索博客，按相关度排序
+@get('/api/search')
+async def api_search(*, q='', page='1'):
+    if not q.strip():
+        raise APIValueError('q', 'query cannot be empty.')
+    results = search.search(q)
+    p = Page(len(results), get_page_index(page))
+    results = results[p.offset:p.offset + p.limit]
+    if not results:
+        return dict(page=p, blogs=())
+    blogs = await Blog.findAll('`id` in (%s)' % create_args_string(len(results)), [doc_id for doc_id, score in results], compact=True)
+    blogs = dict((b.id, b) for b in blogs)
+    items = []
+    for doc_id, score in results:
+        b = blogs.get(doc_id, None)
+        if b is not None:
+            b.score = score
+            items.append(b)
+    return dict(page=p, blogs=items)
+
 # 获取博客
 @get('/api/blogs/{id}')
-@asyncio.coroutine
-def api_get_blog(*, id):
-    blog = yield from Blog.find(id)
+async def api_get_blog(*, id):
+    blog = await Blog.find(id)
     return blog
 
 # 创建博客
 @post('/api/blogs')
-@asyncio.coroutine
-def api_create_blog(request, *, name, summary, content):
+async def api_create_blog(request, *, name, summary, content):
     check_admin(request)
     if not name or not name.strip():
         raise APIValueError('name', 'name cannot be empty.')
@@ -294,14 +324,14 @@ def api_create_blog(request, *, name, summary, content):
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
-    yield from blog.save()
+    await blog.save()
+    search.index_blog(blog)
     return blog
 
 @post('/api/blogs/{id}')
-@asyncio.coroutine
-def api_update_blog(id, request, *, name, summary, content):
+async def api_update_blog(id, request, *, name, summary, content):
     check_admin(request)
-    blog = yield from Blog.find(id)
+    blog = await Blog.find(id)
     if not name or not name.strip():
         raise APIValueError('name', 'name cannot be empty.')
     if not summary or not summary.strip():
@@ -311,13 +341,14 @@ def api_update_blog(id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
-    yield from blog.update()
+    await blog.update()
+    search.index_blog(blog)
     return blog
 
 @post('/api/blogs/{id}/delete')
-@asyncio.coroutine
-def api_delete_blog(request, *, id):
+async def api_delete_blog(request, *, id):
     check_admin(request)
-    blog = yield from Blog.find(id)
-    yield from blog.remove()
+    blog = await Blog.find(id)
+    await blog.remove()
+    search.unindex_blog(id)
     return dict(id=id)
\ No newline at end of file
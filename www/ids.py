@@ -0,0 +1,125 @@
+'''
+Primary key generators, selected by configs.ids.
+
+    legacy      50-char string: 15-digit milliseconds + uuid4 hex + '000', stored as varchar(50)
+    snowflake   time-ordered integer: milliseconds since EPOCH | worker id | sequence, stored as bigint
+
+The generator decides the column type of primary and reference keys, so it
+has to match the schema. Existing databases are converted with migrate_ids.py.
+'''
+
+import time, uuid, threading
+
+from orm import StringField, IntegerField
+from config import configs
+
+# snowflake id的起始时间，2020-01-01 00:00:00 UTC，单位毫秒
+EPOCH = 1577836800000
+
+class LegacyGenerator(object):
+
+    integer = False
+
+    def __init__(self, **kw):
+        pass
+
+    def __call__(self):
+        return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+
+# 默认41位毫秒时间 + 5位worker + 7位序号，一共53位，JavaScript的Number也能精确表示
+# 每个worker每毫秒最多128个id，用完了借用下一毫秒，时钟回拨时沿用上次的时间，保证递增
+class SnowflakeGenerator(object):
+
+    integer = True
+
+    def __init__(self, worker=0, epoch=EPOCH, worker_bits=5, sequence_bits=7):
+        if not 0 <= worker < (1 << worker_bits):
+            raise ValueError('Invalid worker id: %s' % worker)
+        self.worker = worker
+        self.epoch = epoch
+        self.worker_bits = worker_bits
+        self.sequence_bits = sequence_bits
+        self._lock = threading.Lock()
+        self._last = -1
+        self._sequence = 0
+
+    def __call__(self):
+        with self._lock:
+            now = max(int(time.time() * 1000), self._last)
+            if now == self._last:
+                self._sequence = (self._sequence + 1) & ((1 << self.sequence_bits) - 1)
+                if self._sequence == 0:
+                    now += 1
+            else:
+                self._sequence = 0
+            self._last = now
+            return self.make(now, self.worker, self._sequence)
+
+    def make(self, millis, worker, sequence):
+        return (((millis - self.epoch) << self.worker_bits | worker) << self.sequence_bits) | sequence
+
+    # id里的时间，单位秒
+    def timestamp(self, id):
+        return ((id >> (self.worker_bits + self.sequence_bits)) + self.epoch) / 1000.0
+
+    # 把legacy id按里面的毫秒时间换算成snowflake id，同一毫秒里的第n个id用n做序号，序号用完了借用下一毫秒
+    # ids要按字符串顺序传入，返回的整数id保持同样的顺序
+    # 返回逐个转换的函数，按顺序转换的旧id可以分多批传入
+    def converter(self):
+        last, sequence = -1, 0
+        def convert(legacy_id):
+            nonlocal last, sequence
+            millis = max(int(legacy_id[:15]), last)
+            if millis == last:
+                sequence += 1
+                if sequence >> self.sequence_bits:
+                    millis, sequence = millis + 1, 0
+            else:
+                sequence = 0
+            last = millis
+            return self.make(millis, self.worker, sequence)
+        return convert
+
+    def convert(self, legacy_ids):
+        convert = self.converter()
+        return [convert(legacy_id) for legacy_id in legacy_ids]
+
+_generators = dict(legacy=LegacyGenerator, snowflake=SnowflakeGenerator)
+_current = None
+
+def register_generator(name, factory):
+    _generators[name] = factory
+
+def configure(generator='legacy', **kw):
+    global _current
+    if generator not in _generators:
+        raise ValueError('Invalid id generator: %s' % generator)
+    _current = _generators[generator](**kw)
+
+def generator():
+    return _current
+
+def next_id():
+    return _current()
+
+# 是否使用整数id
+def integer_ids():
+    return _current.integer
+
+# 主键字段
+def primary_key():
+    if _current.integer:
+        return IntegerField(primary_key=True, default=next_id)
+    return StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+
+# 引用其他表主键的字段
+def reference():
+    if _current.integer:
+        return IntegerField()
+    return StringField(ddl='varchar(50)')
+
+# 游标翻页的排序列，整数id本身按时间递增，直接按主键排序，不再需要created_at
+def cursor():
+    return ('id',) if _current.integer else None
+
+configure(**configs.ids)
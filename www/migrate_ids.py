@@ -0,0 +1,125 @@
+'''
+Convert the varchar(50) primary keys of an existing MySQL database to snowflake bigint ids.
+
+    python migrate_ids.py            print the migration statements
+    python migrate_ids.py --apply    run the migration
+
+Stop the app first, and switch configs.ids.generator to 'snowflake' after the
+migration. Each legacy id becomes a snowflake id built from the millisecond
+it starts with, so ids keep their order. Reference columns are rewritten to
+the new ids. Users keep their old id in legacy_id, because it salts their
+password. Archive tables of models with __archive__ are migrated with their
+model.
+'''
+
+import sys, asyncio, logging
+
+import orm, ids
+from config import configs
+from models import User, Blog, Comment
+
+MODELS = (User, Blog, Comment)
+# 引用其他表主键的列
+REFERENCES = {
+    Blog: dict(user_id=User),
+    Comment: dict(blog_id=Blog, user_id=User)
+}
+
+class Migration(object):
+
+    def __init__(self, apply):
+        self.apply = apply
+        self.generator = ids.SnowflakeGenerator(worker=configs.ids.worker)
+        self.tables = [] # (Model子类, 表名)，归档表跟在主表后面
+
+    # 要迁移的表，已经建好的归档表和主表一起迁移
+    async def find_tables(self):
+        existing = await orm.table_names()
+        for cls in MODELS:
+            self.tables.append((cls, cls.__table__))
+            if cls.__archive__ is not None and cls.__archive__.table in existing:
+                self.tables.append((cls, cls.__archive__.table))
+
+    async def run(self, sql, args=None):
+        print('%s;' % sql)
+        if self.apply:
+            await orm.execute(sql, args or [])
+
+    # 第一步：加上存放新id的列
+    async def add_columns(self, cls, table):
+        columns = ['add column `new_id` bigint not null default 0']
+        columns.extend('add column `new_%s` bigint not null default 0' % k for k in REFERENCES.get(cls, {}))
+        if cls is User:
+            columns.append("add column `legacy_id` varchar(50) not null default ''")
+        await self.run('alter table `%s` %s' % (table, ', '.join(columns)))
+
+    # 第二步：按原来的顺序给每一行分配新id，主表和归档表的行一起排序，新id不会重复
+    # 旧id从主库分批流式读出，每攒够chunk行就写一批，不把整张表的id放在内存里
+    async def assign_ids(self, cls, chunk=500):
+        tables = [table for c, table in self.tables if c is cls]
+        sqls = ['update `%s` set `new_id`=? where `id`=?' % table for table in tables]
+        pending, counts = [[] for _ in tables], [0] * len(tables)
+        convert = self.generator.converter()
+        rows = orm.select_iter(' union all '.join('select `id`, %s `_tier_` from `%s`' % (i, table) for i, table in enumerate(tables))
+                               + ' order by `id`', [], chunk, primary=True)
+        async for rs in rows:
+            for r in rs:
+                pending[r['_tier_']].append((convert(r['id']), r['id']))
+            for i, pairs in enumerate(pending):
+                if len(pairs) >= chunk:
+                    await self.write_ids(sqls[i], pairs)
+                    counts[i] += len(pairs)
+                    pending[i] = []
+        for i, table in enumerate(tables):
+            await self.write_ids(sqls[i], pending[i])
+            print('-- %s rows: %s;' % (counts[i] + len(pending[i]), sqls[i]))
+            if cls is User:
+                await self.run('update `%s` set `legacy_id`=`id`' % table)
+
+    async def write_ids(self, sql, pairs):
+        if self.apply and pairs:
+            await orm.executemany(sql, pairs)
+
+    # 第三步：引用列换成被引用行的新id，找不到的行写0
+    async def assign_references(self, cls, table):
+        for column, target in REFERENCES.get(cls, {}).items():
+            await self.run('update `%s` set `new_%s`=coalesce((select `new_id` from `%s` where `%s`.`id`=`%s`.`%s`), 0)' % (
+                table, column, target.__table__, target.__table__, table, column))
+
+    # 第四步：删掉原来的列，新列改成原来的名字，重建主键和索引
+    async def swap_columns(self, cls, table):
+        indexes = await orm.table_indexes(table)
+        references = list(REFERENCES.get(cls, {}))
+        drops = ['drop index `%s`' % name for name in indexes]
+        drops.append('drop primary key')
+        drops.extend('drop column `%s`' % k for k in ['id'] + references)
+        await self.run('alter table `%s` %s' % (table, ', '.join(drops)))
+        changes = ['change column `new_%s` `%s` bigint not null' % (k, k) for k in ['id'] + references]
+        changes.append('add primary key (`id`)')
+        changes.extend('add %skey `%s` (%s)' % ('unique ' if unique else '', name, ', '.join('`%s`' % c for c in columns))
+                       for name, (columns, unique) in indexes.items())
+        await self.run('alter table `%s` %s' % (table, ', '.join(changes)))
+
+    async def migrate(self):
+        await self.find_tables()
+        for cls, table in self.tables:
+            await self.add_columns(cls, table)
+        for cls in MODELS:
+            await self.assign_ids(cls)
+        for cls, table in self.tables:
+            await self.assign_references(cls, table)
+        for cls, table in self.tables:
+            await self.swap_columns(cls, table)
+
+async def main(argv):
+    if ids.integer_ids():
+        raise RuntimeError('configs.ids.generator must stay legacy until the migration is done.')
+    if configs.db.backend != 'mysql':
+        raise RuntimeError('migrate_ids.py only supports MySQL.')
+    await orm.create_pool(loop=None, **configs.db)
+    await Migration('--apply' in argv).migrate()
+    logging.info('done, set configs.ids.generator to snowflake before starting the app.')
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(sys.argv[1:]))
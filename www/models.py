@@ -1,40 +1,59 @@
-import time, uuid
+import time
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
-
-def next_id():
-    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+import ids
+from orm import Model, StringField, BooleanField, FloatField, TextField, IntegerField
+from ids import next_id
 
 class User(Model):
     __table__ = 'users'
+    __counter__ = 'exact'
+    __cache__ = dict(size=10000, ttl=60)
+    __cursor__ = ids.cursor()
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    id = ids.primary_key()
+    email = StringField(ddl='varchar(50)', unique=True)
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
+    # 整数id迁移前注册的用户，密码用原来的字符串id加盐
+    if ids.integer_ids():
+        legacy_id = StringField(ddl='varchar(50)', default='')
 
 class Blog(Model):
     __table__ = 'blogs'
+    __counter__ = 'exact'
+    __cache__ = dict(size=1000, ttl=60)
+    __cursor__ = ids.cursor()
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = ids.primary_key()
+    user_id = ids.reference()
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(deferred=True, ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
+    # 评论数，由Comment的插入删除维护，定期和comments表核对
+    comment_count = IntegerField()
 
 class Comment(Model):
     __table__ = 'comments'
-
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    # 博客页按blog_id查评论并按created_at排序
+    __indexes__ = [('blog_id', 'created_at')]
+    __counter__ = 'exact'
+    # 评论只追加，集中发评论时合并成多行insert写入
+    __write_behind__ = dict(interval=0.05, rows=200, limit=5000)
+    __count_in__ = dict(blog_id=(Blog, 'comment_count'))
+    # 90天前的评论移到归档表，博客页只查博客发布之后的评论，新博客不用查归档表
+    __archive__ = dict(table='comments_archive', column='created_at', age=90 * 86400)
+    __cursor__ = ids.cursor()
+
+    id = ids.primary_key()
+    blog_id = ids.reference()
+    user_id = ids.reference()
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
\ No newline at end of file
+    content = TextField(ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
\ No newline at end of file
@@ -1,60 +1,531 @@
-import asyncio, logging
+import asyncio, logging, json, base64, contextlib, contextvars, time, bisect, collections, random
 
-import aiomysql
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
 
 logging.basicConfig(level=logging.INFO)
-def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
 
-# 创建sql连接池
+# SQL跟踪：每条语句记录参数个数、执行时间、行数和等待连接的时间
+# sample是记录普通语句的比例，超过slow秒的语句一定记录到慢查询日志，explain为True时顺便记录select的执行计划
+# 同一条语句explain_interval秒内只explain一次，数据库变慢时不会让连接池上的语句翻倍
+_sql_logger = logging.getLogger('orm.sql')
+_slow_logger = logging.getLogger('orm.slow')
+_tracing = dict(sample=1.0, slow=0.5, explain=True, explain_interval=600)
+_trace_hooks = [] # 每条被采样的语句调用hook(record)，record是dict
+_explained = {} # 语句 => 上次explain的时间
+_explain_tasks = set() # 还没完成的explain任务，保留引用防止被回收
+
+def configure_tracing(sample=None, slow=None, explain=None, explain_interval=None):
+    if sample is not None:
+        _tracing['sample'] = sample
+    if slow is not None:
+        _tracing['slow'] = slow
+    if explain is not None:
+        _tracing['explain'] = explain
+    if explain_interval is not None:
+        _tracing['explain_interval'] = explain_interval
+
+def add_trace_hook(fn):
+    _trace_hooks.append(fn)
+
+def remove_trace_hook(fn):
+    _trace_hooks.remove(fn)
+
+# started是拿到连接的时间，wait是等待连接的秒数
+def trace(sql, args, started, rows, wait):
+    elapsed = time.monotonic() - started
+    slow = _tracing['slow'] is not None and elapsed >= _tracing['slow']
+    if slow:
+        _slow_logger.warning('slow SQL %.1fms (wait %.1fms, rows %s, args %s): %s', elapsed * 1000, wait * 1000, rows, len(args or ()), sql)
+        if _tracing['explain'] and sql.lstrip()[:6].lower() == 'select':
+            schedule_explain(sql, args)
+    elif _tracing['sample'] < 1.0 and random.random() >= _tracing['sample']:
+        return
+    if _sql_logger.isEnabledFor(logging.INFO):
+        _sql_logger.info('SQL %.1fms (wait %.1fms, rows %s, args %s): %s', elapsed * 1000, wait * 1000, rows, len(args or ()), sql)
+    if _trace_hooks:
+        record = dict(statement=sql, args=len(args or ()), elapsed=elapsed, rows=rows, wait=wait, slow=slow)
+        for hook in _trace_hooks:
+            hook(record)
+
+# 同一条语句在explain_interval秒内只explain一次
+def schedule_explain(sql, args):
+    now = time.monotonic()
+    if _explained.get(sql, -1e9) > now - _tracing['explain_interval']:
+        return
+    if len(_explained) > 1000:
+        for k in [k for k, t in _explained.items() if t <= now - _tracing['explain_interval']]:
+            del _explained[k]
+    _explained[sql] = now
+    task = asyncio.ensure_future(explain(sql, args))
+    _explain_tasks.add(task)
+    task.add_done_callback(_explain_tasks.discard)
+
+# 在单独的连接上查询慢语句的执行计划，写到慢查询日志
+async def explain(sql, args):
+    try:
+        async with checkout(choose_read_pool()) as conn:
+            async with conn.cursor(_backend.DictCursor) as cur:
+                await cur.execute(_backend.translate(_backend.EXPLAIN + sql), args or ())
+                rs = await cur.fetchall()
+        _slow_logger.warning('EXPLAIN %s\n%s', sql, '\n'.join(str(r) for r in rs))
+    except Exception as e:
+        _slow_logger.warning('EXPLAIN failed: %s', e)
+
+# 直方图，记录落在每个区间里的次数，区间上界单位是秒
+class Histogram(object):
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return dict(count=self.count, sum=self.sum, max=self.max,
+                    avg=self.sum / self.count if self.count else 0.0,
+                    buckets=list(zip(self.buckets + ('+Inf',), self.counts)))
+
+# 连接池统计：取连接的等待时间、连接占用时间，以及使用中、空闲、排队等待的连接数
+class PoolStats(object):
+
+    def __init__(self, pool=None):
+        self.pool = pool
+        self.wait = Histogram()
+        self.hold = Histogram()
+        self.checkouts = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.in_use = 0
+        self.max_in_use = 0
+
+    def snapshot(self):
+        pool = self.pool
+        maxsize = pool.maxsize if pool is not None else 0
+        return dict(
+            size=pool.size if pool is not None else 0,
+            freesize=pool.freesize if pool is not None else 0,
+            maxsize=maxsize,
+            in_use=self.in_use,
+            max_in_use=self.max_in_use,
+            saturation=self.in_use / maxsize if maxsize else 0.0,
+            waiting=self.waiting,
+            max_waiting=self.max_waiting,
+            checkouts=self.checkouts,
+            wait=self.wait.snapshot(),
+            hold=self.hold.snapshot())
+
+__stats = PoolStats()
+__replicas = [] # 只读副本连接池的统计，PoolStats.pool是对应的连接池
+
+# 查询连接池统计，replicas是各个只读副本的统计
+def pool_stats():
+    r = __stats.snapshot()
+    r['replicas'] = [stats.snapshot() for stats in __replicas]
+    return r
+
+# 清空累计的统计，当前的使用中、排队数量保留
+def reset_pool_stats():
+    for stats in [__stats] + __replicas:
+        stats.wait = Histogram()
+        stats.hold = Histogram()
+        stats.checkouts = 0
+        stats.max_waiting = stats.waiting
+        stats.max_in_use = stats.in_use
+
+# 数据库后端，提供create_pool、三种游标类型和sql转换函数translate
+# 连接池、连接、游标的接口和aiomysql相同，select/execute只通过这些接口访问数据库
+class MySQLBackend(object):
+
+    def __init__(self):
+        if aiomysql is None:
+            raise RuntimeError('aiomysql is required for the mysql backend')
+        self.Cursor = aiomysql.Cursor
+        self.DictCursor = aiomysql.DictCursor
+        self.SSDictCursor = aiomysql.SSDictCursor
+
+    EXPLAIN = 'explain '
+    # 整理表的存储空间，归档表压缩后用
+    COMPACT = 'optimize table `{table}`'
+
+    # 查询现有的表、列和索引，索引不包括主键
+    TABLE_QUERY = 'select table_name table_name from information_schema.tables where table_schema = database()'
+    COLUMN_QUERY = 'select column_name column_name from information_schema.columns where table_schema = database() and table_name = ?'
+    INDEX_QUERY = "select index_name index_name, column_name column_name, non_unique non_unique from information_schema.statistics where table_schema = database() and table_name = ? and index_name <> 'PRIMARY' order by index_name, seq_in_index"
+
+    # 从InnoDB的表统计里读估算的行数，不用扫描整张表
+    ESTIMATE_COUNT = 'select table_rows _num_ from information_schema.tables where table_schema = database() and table_name = ?'
+
+    # 是否主键或唯一索引冲突的错误，ER_DUP_ENTRY
+    def is_duplicate_key(self, e):
+        return isinstance(e, aiomysql.IntegrityError) and bool(e.args) and e.args[0] == 1062
+
+    # orm生成的sql用?做占位符，aiomysql用%s
+    def translate(self, sql):
+        return sql.replace('?', '%s')
+
+    # 把多条建表语句拆开，MySQL不需要改写
+    def split_ddl(self, text):
+        return [text]
+
+    async def create_pool(self, loop, **kw):
+        return await aiomysql.create_pool(
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['db'],
+            # 不设置的话从数据库查到的数据就是乱码
+            charset=kw.get('charset', 'utf8'),
+            # 自动提交事务，这样在增删改查时就不用每次都提交了
+            autocommit=kw.get('autocommit', True),
+            maxsize=kw.get('maxsize', 10),
+            minsize=kw.get('minsize', 1),
+            loop=loop
+        )
+
+def create_backend(name):
+    if name == 'mysql':
+        return MySQLBackend()
+    if name == 'sqlite':
+        import sqlite_backend
+        return sqlite_backend
+    raise ValueError('Unknown database backend: %s' % name)
+
+_backend = None
+
+# 创建sql连接池，replicas是只读副本的列表，每项只需写出和主库不同的配置
+# sticky是写入之后同一个会话继续读主库的秒数，保证用户能马上看到自己写的数据
+# backend选择数据库后端，默认mysql，sqlite用于测试和压测，db为文件路径或':memory:'，schema为建表sql文件
 async def create_pool(loop, **kw):
     logging.info('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        # 不设置的话从数据库查到的数据就是乱码
-        charset=kw.get('charset', 'utf8'),
-        # 自动提交事务，这样在增删改查时就不用每次都提交了
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
+    global __pool, __stats, __replicas, __sticky, _backend
+    _backend = create_backend(kw.get('backend', 'mysql'))
+    __pool = await _backend.create_pool(loop, **kw)
+    __stats = PoolStats(__pool)
+    replicas = []
+    for replica in kw.get('replicas', None) or []:
+        logging.info('create replica connection pool: %s' % replica.get('host', kw.get('host', 'localhost')))
+        config = dict(kw)
+        config.update(replica)
+        replicas.append(PoolStats(await _backend.create_pool(loop, **config)))
+    __replicas = replicas
+    __sticky = kw.get('sticky', 5)
+
+# 从连接池取连接，同时记录等待时间和占用时间，stats为None时取主库
+@contextlib.asynccontextmanager
+async def checkout(stats=None):
+    stats = stats or __stats
+    start = time.monotonic()
+    acquired = None
+    stats.waiting += 1
+    stats.max_waiting = max(stats.max_waiting, stats.waiting)
+    try:
+        async with stats.pool.get() as conn:
+            acquired = time.monotonic()
+            stats.waiting -= 1
+            stats.checkouts += 1
+            stats.in_use += 1
+            stats.max_in_use = max(stats.max_in_use, stats.in_use)
+            stats.wait.observe(acquired - start)
+            try:
+                yield conn
+            finally:
+                stats.in_use -= 1
+                stats.hold.observe(time.monotonic() - acquired)
+    finally:
+        if acquired is None:
+            stats.waiting -= 1
+
+# 当前会话，由中间件按用户设置，写入后的一小段时间内这个会话的读请求走主库
+_session = contextvars.ContextVar('orm_session', default=None)
+__sticky = 5
+__written = {} # 会话 => 读主库的截止时间
+
+def bind_session(key):
+    return _session.set(key)
+
+def unbind_session(token):
+    _session.reset(token)
+
+# 记录会话刚写过数据，keys为空时标记当前会话，写入队列在后台写完后按放入时记下的会话标记
+def mark_written(*keys):
+    keys = [k for k in keys or (_session.get(),) if k is not None]
+    if not keys or not __replicas:
+        return
+    now = time.monotonic()
+    if len(__written) > 10000:
+        for k in [k for k, t in __written.items() if t < now]:
+            del __written[k]
+    for key in keys:
+        __written[key] = now + __sticky
+
+# 当前会话是否刚写过数据，还在读主库的时间内
+def session_sticky():
+    key = _session.get()
+    return key is not None and __written.get(key, 0) > time.monotonic()
+
+# 读请求是否走主库，没有只读副本或会话刚写过数据时走主库
+def reads_primary():
+    return not __replicas or session_sticky()
+
+# 选择读连接池：会话刚写过数据就读主库，否则选未完成请求最少的只读副本
+def choose_read_pool():
+    if reads_primary():
+        return __stats
+    return min(__replicas, key=lambda stats: (stats.in_use + stats.waiting, stats.checkouts))
+
+
+# 根据Model的字段和索引声明生成建表语句，table为归档表时使用压缩的行格式
+def create_table_sql(cls, table=None):
+    lines = ['`%s` %s not null' % (k, cls.__mappings__[k].column_type) for k in [cls.__primary_key__] + cls.__fields__]
+    for name, columns, unique in cls.__indexes__:
+        lines.append('%skey `%s` (%s)' % ('unique ' if unique else '', name, ', '.join('`%s`' % c for c in columns)))
+    lines.append('primary key (`%s`)' % cls.__primary_key__)
+    options = 'engine=innodb default charset=utf8'
+    if table is not None and table != cls.__table__:
+        options = 'engine=innodb row_format=compressed default charset=utf8'
+    return 'create table `%s` (\n    %s\n) %s' % (table or cls.__table__, ',\n    '.join(lines), options)
+
+# 给已有的表加上Model里新增的列，已有的行用字段的默认值填充
+def add_column_sql(cls, name, table=None):
+    field = cls.__mappings__[name]
+    default = field.default
+    if default is None or callable(default):
+        clause = ''
+    elif isinstance(default, str):
+        clause = " default '%s'" % default.replace("'", "''")
+    else:
+        clause = ' default %s' % int(default) if isinstance(default, bool) else ' default %s' % default
+    return 'alter table `%s` add column `%s` %s not null%s' % (table or cls.__table__, name, field.column_type, clause)
+
+def create_index_sql(cls, index, table=None):
+    name, columns, unique = index
+    return 'create %sindex `%s` on `%s` (%s)' % ('unique ' if unique else '', name, table or cls.__table__, ', '.join('`%s`' % c for c in columns))
+
+# 查询库里现有的表名
+async def table_names():
+    return set(r['table_name'] for r in await select(_backend.TABLE_QUERY, []))
+
+# 查询表上现有的索引，返回索引名 => (列, 是否唯一)，不包括主键
+async def table_indexes(table):
+    indexes = collections.OrderedDict()
+    for r in await select(_backend.INDEX_QUERY, [table]):
+        columns, unique = indexes.setdefault(r['index_name'], ([], not r['non_unique']))
+        columns.append(r['column_name'])
+    return collections.OrderedDict((name, (tuple(columns), unique)) for name, (columns, unique) in indexes.items())
+
+# 和数据库里现有的表结构比较，返回缺少的表、列和索引的建表、加列、建索引语句
+# 索引按列和是否唯一比较，不看索引名，数据库里多出来的列和索引只打日志不删除
+async def diff_schema(*models):
+    tables = await table_names()
+    statements = []
+    for cls in models:
+        # 有归档表的Model，归档表和主表的结构相同
+        for table in [cls.__table__] + ([cls.__archive__.table] if cls.__archive__ is not None else []):
+            if table not in tables:
+                statements.append(create_table_sql(cls, table))
+                continue
+            columns = set(r['column_name'] for r in await select(_backend.COLUMN_QUERY, [table]))
+            for k in [cls.__primary_key__] + cls.__fields__:
+                if k not in columns:
+                    statements.append(add_column_sql(cls, k, table))
+            existing = set((await table_indexes(table)).values())
+            declared = set()
+            for index in cls.__indexes__:
+                declared.add((index[1], index[2]))
+                if (index[1], index[2]) not in existing:
+                    statements.append(create_index_sql(cls, index, table))
+            for columns, unique in existing - declared:
+                logging.info('undeclared index on %s: (%s)' % (table, ', '.join(columns)))
+    return statements
+
+# 执行diff_schema得到的语句，返回执行了的语句
+async def apply_schema(*models):
+    statements = await diff_schema(*models)
+    for sql in statements:
+        for stmt in _backend.split_ddl(sql):
+            await execute(stmt, [])
+    return statements
+
+# 事务中固定使用的连接，同一个上下文里的Model调用通过contextvar拿到同一个连接
+_tx_conn = contextvars.ContextVar('orm_tx_conn', default=None)
+
+# 获取连接，在事务里就用事务的连接，否则从连接池里取，read为True时可以读只读副本
+@contextlib.asynccontextmanager
+async def get_connection(read=False):
+    conn = _tx_conn.get()
+    if conn is not None:
+        yield conn
+        return
+    async with checkout(choose_read_pool() if read else None) as conn:
+        yield conn
+
+# 事务，用法：async with orm.transaction(): ...
+# 期间所有select/execute都用同一个连接，正常退出提交，出错回滚，嵌套的事务并入最外层
+@contextlib.asynccontextmanager
+async def transaction():
+    conn = _tx_conn.get()
+    if conn is not None:
+        yield conn
+        return
+    async with checkout() as conn:
+        await conn.begin()
+        token = _tx_conn.set(conn)
+        deltas_token = _tx_deltas.set([])
+        invalidations_token = _tx_invalidations.set([])
+        try:
+            yield conn
+        except BaseException:
+            await conn.rollback()
+            # 回滚后identity map里可能有没写进数据库的对象
+            imap = _identity.get()
+            if imap is not None:
+                imap.clear()
+            raise
+        else:
+            await conn.commit()
+            for counter, delta in _tx_deltas.get():
+                counter.add(delta)
+        finally:
+            # 提交或回滚后再让事务里改过的行失效一次，事务期间别的请求可能把提交前的旧行放回了缓存
+            for cls, pk in _tx_invalidations.get():
+                cls.__rowcache__.discard(pk)
+            _tx_invalidations.reset(invalidations_token)
+            _tx_deltas.reset(deltas_token)
+            _tx_conn.reset(token)
+
+# 请求内的identity map，由中间件在每个请求开始时创建，同一请求里按主键查过的对象直接复用
+_identity = contextvars.ContextVar('orm_identity', default=None)
+# 请求内的批量加载器，Model类 => BatchLoader
+_loaders = contextvars.ContextVar('orm_loaders', default=None)
+
+def begin_identity_map():
+    return _identity.set({}), _loaders.set({})
+
+def end_identity_map(token):
+    identity_token, loaders_token = token
+    _loaders.reset(loaders_token)
+    _identity.reset(identity_token)
+
+# 批量加载器，同一轮事件循环里的load(pk)合并成一条where id in (...)查询
+class BatchLoader(object):
+
+    def __init__(self, cls):
+        self.cls = cls
+        self._pending = {} # 主键 => future
+
+    def load(self, pk):
+        fut = self._pending.get(pk)
+        if fut is None:
+            loop = asyncio.get_event_loop()
+            if not self._pending:
+                loop.call_soon(self._dispatch)
+            fut = self._pending[pk] = loop.create_future()
+        return fut
 
+    def _dispatch(self):
+        pending, self._pending = self._pending, {}
+        asyncio.ensure_future(self._fetch(pending))
+
+    async def _fetch(self, pending):
+        try:
+            objs = await self.cls.find_many(list(pending.keys()))
+        except Exception as e:
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for fut, obj in zip(pending.values(), objs):
+            if not fut.done():
+                fut.set_result(obj)
+
+# 把完整加载的对象放进identity map，已经有的不覆盖
+def identity_add(obj, replace=False):
+    imap = _identity.get()
+    if imap is None:
+        return
+    key = (obj.__class__, obj.getValue(obj.__primary_key__))
+    if replace or key not in imap:
+        imap[key] = obj
+
+def identity_discard(cls, pk):
+    imap = _identity.get()
+    if imap is not None:
+        imap.pop((cls, pk), None)
 
 # select语句，传入sql语句，args占位符，和查询数量size
-async def select(sql, args, size=None):
-    log(sql, args)
-    global __pool
-    async with __pool.get() as conn:
+# tuples为True时直接返回元组，省去每行构造一个dict
+async def select(sql, args, size=None, tuples=False):
+    start = time.monotonic()
+    async with get_connection(read=True) as conn:
+        started = time.monotonic()
         # 获取游标，通过游标操作数据库，游标默认是元祖，这里把他转换为字典
-        async with conn.cursor(aiomysql.DictCursor) as cur:
+        async with conn.cursor(_backend.Cursor if tuples else _backend.DictCursor) as cur:
             # 替换的占位符，避免sql直接拼接造成sql注入
-            await cur.execute(sql.replace('?', '%s'), args or ())
+            await cur.execute(_backend.translate(sql), args or ())
             # 获取size大小，不给定就是获取全部
             if size:
                 rs = await cur.fetchmany(size)
             else:
                 rs = await cur.fetchall()
-        logging.info('rows returned: %s' % len(rs))
+        trace(sql, args, started, len(rs), started - start)
         return rs
 
+# 并发执行互不依赖的查询，每个查询从连接池取各自的连接，总耗时接近最慢的那个查询
+# 事务里只有一个连接，只能依次执行
+async def gather_queries(*aws):
+    if _tx_conn.get() is not None:
+        return [await aw for aw in aws]
+    return list(await asyncio.gather(*aws))
+
+# 流式select，用无缓冲的SSDictCursor每次取batch行，整个结果集不会一次读进内存
+# primary=True时从主库读，不走从库
+async def select_iter(sql, args, batch=100, primary=False):
+    start = time.monotonic()
+    # 注意：遍历结束前这个连接不能执行别的语句
+    async with get_connection(read=not primary) as conn:
+        started = time.monotonic()
+        rows = 0
+        async with conn.cursor(_backend.SSDictCursor) as cur:
+            await cur.execute(_backend.translate(sql), args or ())
+            while True:
+                rs = await cur.fetchmany(batch)
+                if not rs:
+                    break
+                rows += len(rs)
+                yield rs
+        trace(sql, args, started, rows, started - start)
+
 # 为增删改统一设置execute函数，因为这三个东东参数相同，就提取一下
 async def execute(sql, args, autocommit=True):
-    log(sql)
-    async with __pool.get() as conn:
-        # 如果没有自动提交事务，就手动提交
+    start = time.monotonic()
+    async with get_connection() as conn:
+        started = time.monotonic()
+        # 如果没有自动提交事务，就手动提交，在transaction()里由事务统一提交
+        if _tx_conn.get() is not None:
+            autocommit = True
         if not autocommit:
             await conn.begin()
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
+            async with conn.cursor(_backend.DictCursor) as cur:
+                await cur.execute(_backend.translate(sql), args)
                 # 获取增删改影响的行数，不用获取select的结果集
                 affected = cur.rowcount
+            trace(sql, args, started, affected, started - start)
+            mark_written()
             if not autocommit:
                 await conn.commit()
         except BaseException as e:
@@ -64,6 +535,29 @@ async def execute(sql, args, autocommit=True):
             raise
         return affected
 
+# 批量执行同一条增删改语句，args_list里每一项是一行的参数
+async def executemany(sql, args_list, autocommit=True):
+    start = time.monotonic()
+    async with get_connection() as conn:
+        started = time.monotonic()
+        if _tx_conn.get() is not None:
+            autocommit = True
+        if not autocommit:
+            await conn.begin()
+        try:
+            async with conn.cursor(_backend.DictCursor) as cur:
+                await cur.executemany(_backend.translate(sql), args_list)
+                affected = cur.rowcount
+            trace(sql, args_list, started, affected, started - start)
+            mark_written()
+            if not autocommit:
+                await conn.commit()
+        except BaseException as e:
+            if not autocommit:
+                await conn.rollback()
+            raise
+        return affected
+
 # 用来计算要拼接多少个占位符
 def create_args_string(num):
     L = []
@@ -71,6 +565,50 @@ def create_args_string(num):
         L.append('?')
     return ', '.join(L)
 
+# 生成select语句，fields为要查询的非主键列
+def create_select_string(tableName, primaryKey, fields):
+    return 'select %s from `%s`' % (', '.join('`%s`' % f for f in [primaryKey] + list(fields)), tableName)
+
+# 生成按主键更新指定列的update语句
+def create_update_string(tableName, mappings, fields, primaryKey):
+    return 'update `%s` set %s where `%s`=?' % (
+        tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
+
+# 插入，主键或唯一索引冲突时改成更新fields这些列
+def create_upsert_string(insert, mappings, fields):
+    columns = [mappings.get(f).name or f for f in fields]
+    return '%s on duplicate key update %s' % (insert, ', '.join('`%s`=values(`%s`)' % (c, c) for c in columns))
+
+# 把游标值编码成不透明的字符串，翻页时由客户端原样传回
+def encode_cursor(values):
+    s = json.dumps(list(values), separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+# 解析客户端传回的游标字符串
+# size为排序列的个数，游标里要有同样多个值，并且都是字符串或数字
+def decode_cursor(token, size=None):
+    try:
+        s = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(s.decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor: %s' % token)
+    if not isinstance(values, list) or (size is not None and len(values) != size):
+        raise ValueError('Invalid cursor: %s' % token)
+    for v in values:
+        if isinstance(v, bool) or not isinstance(v, (str, int, float)):
+            raise ValueError('Invalid cursor: %s' % token)
+    return values
+
+# 生成游标翻页的条件，(a, b) < (?, ?) 展开成 a < ? or (a = ? and b < ?)，这样才能用上索引
+def create_keyset_string(columns, values, desc=True):
+    op = '<' if desc else '>'
+    sql = '`%s` %s ?' % (columns[-1], op)
+    args = [values[-1]]
+    for c, v in zip(reversed(columns[:-1]), reversed(values[:-1])):
+        sql = '(`%s` %s ? or (`%s` = ? and %s))' % (c, op, c, sql)
+        args = [v, v] + args
+    return sql, args
+
 
 # 用于保存数据库的列名和基类的类型
 class Field(object):
@@ -80,6 +618,9 @@ class Field(object):
         self.column_type = column_type #列类型
         self.primary_key = primary_key #是否主键
         self.default = default
+        self.deferred = False #是否延迟加载
+        self.index = False #是否单独建索引
+        self.unique = False #是否唯一索引
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -87,8 +628,10 @@ class Field(object):
 # 保存列名的数据类型
 class StringField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False, unique=False):
         super().__init__(name, ddl, primary_key, default)
+        self.index = index
+        self.unique = unique
 
 class BooleanField(Field):
 
@@ -97,18 +640,461 @@ class BooleanField(Field):
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
         super().__init__(name, 'bigint', primary_key, default)
+        self.index = index
+        self.unique = unique
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False, unique=False):
         super().__init__(name, 'real', primary_key, default)
+        self.index = index
+        self.unique = unique
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    # deferred=True时列表查询不取这一列，需要时再单独加载
+    def __init__(self, name=None, default=None, deferred=False, ddl='text'):
+        super().__init__(name, ddl, False, default)
+        self.deferred = deferred
+
+# 按主键缓存行数据的LRU缓存，条目超过ttl秒就过期
+# 在Model子类上声明__cache__ = dict(size=10000, ttl=60)即可启用
+class RowCache(object):
+
+    def __init__(self, size=1000, ttl=60):
+        self.maxsize = size
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.version = 0 # 每次失效加一
+
+    def get(self, pk):
+        item = self._data.get(pk)
+        if item is None:
+            self.misses += 1
+            return None
+        row, expires = item
+        if expires < time.monotonic():
+            del self._data[pk]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(pk)
+        self.hits += 1
+        return row
+
+    # version为查询前的self.version，查询期间有行失效过就不放进缓存，避免放回提交前读到的旧数据
+    def put(self, pk, row, version=None):
+        if version is not None and version != self.version:
+            return
+        self._data[pk] = (row, time.monotonic() + self.ttl)
+        self._data.move_to_end(pk)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, pk):
+        self.version += 1
+        self._data.pop(pk, None)
+
+    def clear(self):
+        self.version += 1
+        self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(size=len(self._data), maxsize=self.maxsize, ttl=self.ttl,
+                    hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    expirations=self.expirations, hit_rate=self.hits / lookups if lookups else 0.0)
+
+_caches = {} # 表名 => RowCache
+
+# 查询所有行缓存的命中、未命中、淘汰次数
+def cache_stats():
+    return dict((table, cache.stats()) for table, cache in _caches.items())
+
+# 表的行数计数器，启动时统计一次，之后由save/remove增减，定期和数据库核对
+# 在Model子类上声明__counter__ = 'exact'启用，'approx'表示用表统计信息估算，适合特别大的表
+class RowCounter(object):
+
+    def __init__(self, mode='exact'):
+        if mode not in ('exact', 'approx'):
+            raise ValueError('Invalid counter mode: %s' % mode)
+        self.mode = mode
+        self.value = None # 还没有统计过
+        self.reconciled_at = None
+        self.drift = 0 # 上次核对时和数据库相差的行数
+
+    def add(self, delta):
+        if self.value is not None:
+            self.value = max(0, self.value + delta)
+
+    def stats(self):
+        return dict(mode=self.mode, value=self.value, reconciled_at=self.reconciled_at, drift=self.drift)
+
+_counters = {} # 表名 => (Model子类, RowCounter)
+# 事务里的计数变化，提交后才生效，回滚就丢弃
+_tx_deltas = contextvars.ContextVar('orm_tx_deltas', default=None)
+# 事务里失效过的行缓存，(Model子类, 主键)
+_tx_invalidations = contextvars.ContextVar('orm_tx_invalidations', default=None)
+
+def count_delta(counter, delta):
+    if counter is None or delta == 0:
+        return
+    deltas = _tx_deltas.get()
+    if deltas is not None:
+        deltas.append((counter, delta))
+    else:
+        counter.add(delta)
+
+# 统计一张表的行数，有归档表时加上归档表的行数
+async def count_rows(cls, mode='exact'):
+    return sum([await count_table_rows(table, mode) for table in cls.tablesOf()])
+
+async def count_table_rows(table, mode='exact'):
+    if mode == 'approx' and getattr(_backend, 'ESTIMATE_COUNT', None):
+        rs = await select(_backend.ESTIMATE_COUNT, [table], 1)
+        if rs and rs[0]['_num_'] is not None:
+            return int(rs[0]['_num_'])
+    rs = await select('select count(*) _num_ from `%s`' % table, None, 1)
+    return rs[0]['_num_']
+
+# 重新统计所有计数器，启动时和定期核对时调用
+async def reconcile_counters():
+    for table, (cls, counter) in list(_counters.items()):
+        value = await count_rows(cls, counter.mode)
+        if counter.value is not None and counter.value != value:
+            counter.drift = value - counter.value
+            logging.info('counter of %s drifted by %s' % (table, counter.drift))
+        counter.value = value
+        counter.reconciled_at = time.time()
+    await reconcile_parent_counts()
+
+# 子表行数在父表上的计数列，(子表Model, 引用列, 父表Model, 计数列)
+# 在子表上声明__count_in__ = dict(blog_id=(Blog, 'comment_count'))，插入删除子表时按引用列增减父表的计数
+_parent_counts = []
+
+# 按引用列增减父表上的计数，rows为插入或删除的行，sign为1或-1，同一个父行的变化合并成一条update
+async def count_in_parents(cls, rows, sign):
+    deltas = collections.OrderedDict()
+    for fk, (parent, field) in cls.__count_in__.items():
+        for r in rows:
+            key = (parent, field, r.get(fk))
+            deltas[key] = deltas.get(key, 0) + sign
+    for (parent, field, pk), delta in deltas.items():
+        await parent.increment(pk, field, delta)
+
+# 用一条group by统计子表行数，修正父表上不一致的计数
+# 只在计数没有被并发修改时写入，被修改过的留到下次核对
+# 先读父表的计数再统计子表：之间插入的行已经加到父表上，统计结果比读到的计数大，守卫条件对不上就不会写
+# 两次读都在事务里，固定用主库的连接，不会读到落后的副本
+async def reconcile_parent_counts(chunk=500):
+    fixed = 0
+    for cls, fk, parent, field in _parent_counts:
+        tables = cls.tablesOf()
+        if len(tables) == 1:
+            source = '`%s`' % tables[0]
+        else:
+            source = '(%s) _rows_' % ' union all '.join('select `%s` from `%s`' % (fk, t) for t in tables)
+        async with transaction():
+            parents = await select('select `%s` _pk_, `%s` _num_ from `%s`' % (parent.__primary_key__, field, parent.__table__), [])
+            rs = await select('select `%s` _pk_, count(*) _num_ from %s group by `%s`' % (fk, source, fk), [])
+        counts = dict((r['_pk_'], r['_num_']) for r in rs)
+        rs = parents
+        updates = [[counts.get(r['_pk_'], 0), r['_pk_'], r['_num_']] for r in rs if counts.get(r['_pk_'], 0) != r['_num_']]
+        sql = 'update `%s` set `%s`=? where `%s`=? and `%s`=?' % (parent.__table__, field, parent.__primary_key__, field)
+        for i in range(0, len(updates), chunk):
+            await executemany(sql, updates[i:i + chunk])
+        parent.invalidate(*[u[1] for u in updates])
+        if updates:
+            logging.info('%s of %s.%s reconciled' % (len(updates), parent.__table__, field))
+        fixed += len(updates)
+    return fixed
+
+async def init_counters():
+    logging.info('init row counters...')
+    await reconcile_counters()
+
+# 后台定期核对计数器，多个进程写同一个库时靠它修正
+def start_counter_reconciler(interval=600):
+    async def loop():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await reconcile_counters()
+            except Exception as e:
+                logging.exception(e)
+    return asyncio.ensure_future(loop())
+
+def counter_stats():
+    return dict((table, counter.stats()) for table, (cls, counter) in _counters.items())
+
+# 只追加的表的写入队列，save先放进内存队列，每interval秒或攒够rows行合并成一条多行insert写入
+# 在Model子类上声明__write_behind__ = dict(interval=0.05, rows=200, limit=5000)启用，用enqueue()代替save()
+# 队列里超过limit行时enqueue()等待写入腾出空间，进程退出前调用flush_write_queues()写完剩下的行
+class WriteQueue(object):
+
+    def __init__(self, cls, interval=0.05, rows=200, limit=5000):
+        self.cls = cls
+        self.interval = interval
+        self.rows = rows
+        self.limit = limit
+        self._items = [] # (对象, future, 放入时的会话)
+        self._timer = None
+        self._task = None
+        self._space = None # 队列满时等待的future
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.waits = 0
+        self.max_depth = 0
+
+    # 放入一行，返回写入数据库后完成的future
+    async def put(self, obj):
+        if len(self._items) >= self.limit:
+            self.waits += 1
+        while len(self._items) >= self.limit:
+            if self._space is None or self._space.done():
+                self._space = asyncio.get_event_loop().create_future()
+            self._kick()
+            await asyncio.shield(self._space)
+        fut = asyncio.get_event_loop().create_future()
+        self._items.append((obj, fut, _session.get()))
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, len(self._items))
+        if len(self._items) >= self.rows:
+            self._kick()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.interval, self._kick)
+        return fut
+
+    # 启动写入任务，任务在空的上下文里运行，不继承发起请求的事务和会话，写完后再标记各行的会话
+    def _kick(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._task is None or self._task.done():
+            self._task = contextvars.Context().run(asyncio.ensure_future, self._drain())
+
+    async def _drain(self):
+        while self._items:
+            batch, self._items = self._items[:self.rows], self._items[self.rows:]
+            if self._space is not None and not self._space.done() and len(self._items) < self.limit:
+                self._space.set_result(None)
+            await self._write(batch)
+
+    # 整批写入失败时逐行重试，只有出错的那一行的future收到异常
+    async def _write(self, batch):
+        self.batches += 1
+        try:
+            await self.cls.save_many([obj for obj, fut, session in batch], chunk=len(batch))
+        except Exception as e:
+            if len(batch) == 1:
+                logging.exception(e)
+                self.failed += 1
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            logging.warning('write batch of %s rows to %s failed, retry row by row: %s' % (len(batch), self.cls.__table__, e))
+            for item in batch:
+                await self._write([item])
+            return
+        self.written += len(batch)
+        # 放入行的用户接下来读主库，能看到自己刚发的评论
+        mark_written(*set(session for obj, fut, session in batch))
+        for obj, fut, session in batch:
+            if not fut.done():
+                fut.set_result(obj)
+
+    # 写完队列里所有的行
+    async def flush(self):
+        while self._items or (self._task is not None and not self._task.done()):
+            self._kick()
+            await asyncio.shield(self._task)
+
+    def stats(self):
+        return dict(depth=len(self._items), max_depth=self.max_depth, enqueued=self.enqueued,
+                    written=self.written, failed=self.failed, batches=self.batches, waits=self.waits)
+
+_write_queues = {} # 表名 => WriteQueue
+
+async def flush_write_queues():
+    for table, queue in list(_write_queues.items()):
+        logging.info('flush write queue of %s: %s rows' % (table, len(queue._items)))
+        await queue.flush()
+
+def write_queue_stats():
+    return dict((table, queue.stats()) for table, queue in _write_queues.items())
+
+# 按时间归档的冷数据表，archive_rows()把column早于age秒前的行从主表移到归档表，主表只保留最近的数据
+# 在Model子类上声明__archive__ = dict(table='comments_archive', column='created_at', age=90 * 86400)启用
+# 查询先查主表，只有查询范围可能包含age秒以前的行时才查归档表
+class Archive(object):
+
+    def __init__(self, table, column='created_at', age=90 * 86400):
+        self.table = table
+        self.column = column
+        self.age = age
+        self.moved = 0
+        self.archived_at = None
+
+    # 归档表里只有早于now - age的行，查询的下限since比这个时间晚时不用查归档表
+    def touches(self, since=None):
+        return since is None or since < time.time() - self.age
+
+    def stats(self):
+        return dict(table=self.table, column=self.column, age=self.age, moved=self.moved, archived_at=self.archived_at)
+
+_archives = {} # 表名 => (Model子类, Archive)
+
+# 把主表里超过age秒的行分批移到归档表，每批在一个事务里插入归档表再从主表删除，返回移动的行数
+async def archive_rows(cls, chunk=1000):
+    archive = cls.__archive__
+    cutoff = time.time() - archive.age
+    pk = cls.__primary_key__
+    columns = ', '.join('`%s`' % c for c in cls.columnsOf(None, True))
+    moved = 0
+    while True:
+        async with transaction():
+            rs = await select('select `%s` from `%s` where `%s`<? order by `%s` limit ?' % (
+                pk, cls.__table__, archive.column, archive.column), [cutoff, chunk], tuples=True)
+            pks = [r[0] for r in rs]
+            if pks:
+                where = '`%s` in (%s)' % (pk, create_args_string(len(pks)))
+                await execute('insert into `%s` (%s) select %s from `%s` where %s' % (archive.table, columns, columns, cls.__table__, where), pks)
+                await execute('delete from `%s` where %s' % (cls.__table__, where), pks)
+        moved += len(pks)
+        if len(pks) < chunk:
+            break
+    archive.moved += moved
+    archive.archived_at = time.time()
+    if moved:
+        logging.info('%s rows archived from %s to %s' % (moved, cls.__table__, archive.table))
+    return moved
+
+# 整理归档表的存储空间，MySQL上重建成压缩的行格式
+async def compact_archive(cls):
+    await execute(_backend.COMPACT.format(table=cls.__archive__.table), [])
+
+# 后台定期归档所有声明了__archive__的表
+def start_archiver(interval=3600):
+    async def loop():
+        while True:
+            await asyncio.sleep(interval)
+            for table, (cls, archive) in list(_archives.items()):
+                try:
+                    await archive_rows(cls)
+                except Exception as e:
+                    logging.exception(e)
+    return asyncio.ensure_future(loop())
+
+def archive_stats():
+    return dict((table, archive.stats()) for table, (cls, archive) in _archives.items())
+
+# 紧凑的行对象，列值存在__slots__里，不用像Model那样每行一个dict
+# 只读的列表查询用findAll(..., compact=True)得到，属性访问和Model相同，额外设置的属性放在按需创建的_extras里
+class Row(object):
+
+    __slots__ = ('_extras',)
+    __columns__ = ()
+    __setters__ = {}
+
+    # 列以外的属性从_extras里取，没有设置过额外属性的行没有_extras
+    def __getattr__(self, key):
+        try:
+            return object.__getattribute__(self, '_extras')[key]
+        except (AttributeError, KeyError):
+            raise AttributeError(key) from None
+
+    def __setattr__(self, key, value):
+        if key in self.__setters__:
+            object.__setattr__(self, key, value)
+            return
+        try:
+            extras = object.__getattribute__(self, '_extras')
+        except AttributeError:
+            extras = {}
+            object.__setattr__(self, '_extras', extras)
+        extras[key] = value
+
+    def __delattr__(self, key):
+        if key in self.__setters__:
+            object.__delattr__(self, key)
+            return
+        try:
+            del object.__getattribute__(self, '_extras')[key]
+        except (AttributeError, KeyError):
+            raise AttributeError(key) from None
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return list(self._asdict().keys())
+
+    # 转换成dict，用于序列化成JSON
+    def _asdict(self):
+        d = {}
+        for k in self.__columns__:
+            try:
+                d[k] = getattr(self, k)
+            except AttributeError:
+                pass
+        try:
+            d.update(object.__getattribute__(self, '_extras'))
+        except AttributeError:
+            pass
+        return d
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % kv for kv in self._asdict().items()))
+
+    # 用columns对应的位置把元组hydrate成行对象
+    @classmethod
+    def hydrate(cls, columns, rs):
+        setters = [cls.__setters__[c] for c in columns]
+        rows = []
+        for values in rs:
+            row = cls.__new__(cls)
+            for setter, v in zip(setters, values):
+                setter(row, v)
+            rows.append(row)
+        return rows
+
+def create_row_class(name, columns):
+    cls = type(name, (Row,), dict(__slots__=tuple(columns), __columns__=tuple(columns)))
+    cls.__setters__ = dict((c, getattr(cls, c).__set__) for c in columns)
+    return cls
+
+# 整理索引声明，返回(索引名, 列, 是否唯一)的列表
+# 字段上声明index=True或unique=True建单列索引，__indexes__里可以写列名的元组建联合索引，
+# 或者写dict(columns=(...), unique=False, name=None, include=(...))，include里的列追加在索引末尾，用来做覆盖索引
+def create_index_list(mappings, declared):
+    indexes = []
+    for k, f in mappings.items():
+        if (f.index or f.unique) and not f.primary_key:
+            indexes.append(('idx_%s' % k, (k,), bool(f.unique)))
+    for index in declared or []:
+        if not isinstance(index, dict):
+            index = dict(columns=index)
+        columns = tuple(index['columns']) + tuple(index.get('include', ()))
+        for c in columns:
+            if c not in mappings:
+                raise RuntimeError('Index column not found: %s' % c)
+        indexes.append((index.get('name', None) or 'idx_%s' % '_'.join(index['columns']), columns, bool(index.get('unique', False))))
+    return indexes
 
 # 继承于基类model的子类user可以通过这个方法扫描映射关系，并保存到自身的类属性中
 class ModelMetaclass(type):
@@ -147,15 +1133,54 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName     #保存表名
         attrs['__primary_key__'] = primaryKey  # 主键属性名
         attrs['__fields__'] = fields  # 除主键外的属性名
+        attrs['__deferred__'] = [f for f in fields if mappings[f].deferred]  # 延迟加载的属性名
+        attrs['__indexes__'] = create_index_list(mappings, attrs.get('__indexes__', None))  # 索引
+        attrs['__row__'] = create_row_class('%sRow' % name, [primaryKey] + fields)  # 紧凑行对象的类
+        # 声明了__cache__的表按主键缓存行数据
+        cache = attrs.get('__cache__', None)
+        attrs['__rowcache__'] = RowCache(**cache) if cache else None
+        if cache:
+            _caches[tableName] = attrs['__rowcache__']
+        # 声明了__counter__的表在内存里维护行数
+        counter = attrs.get('__counter__', None)
+        attrs['__rowcounter__'] = RowCounter(counter) if counter else None
+        attrs['__count_in__'] = attrs.get('__count_in__', None) or {}
+        # 声明了__archive__的表，旧数据移到归档表
+        archive = attrs.get('__archive__', None)
+        attrs['__archive__'] = Archive(**archive) if archive else None
+        if archive and attrs['__archive__'].column not in mappings:
+            raise RuntimeError('Archive column not found: %s' % attrs['__archive__'].column)
+        # 游标翻页用的排序列，默认按创建时间，主键保证顺序唯一
+        if not attrs.get('__cursor__'):
+            attrs['__cursor__'] = ('created_at', primaryKey) if 'created_at' in mappings else (primaryKey,)
 
         #构造默认的增删改查语句
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
+        # 列表查询用的select语句，不包含延迟加载的列
+        attrs['__select_list__'] = create_select_string(tableName, primaryKey, [f for f in fields if not mappings[f].deferred])
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (
         tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
-        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (
-        tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
+        attrs['__insert_ignore__'] = 'insert ignore' + attrs['__insert__'][len('insert'):]
+        attrs['__upsert__'] = create_upsert_string(attrs['__insert__'], mappings, fields)
+        attrs['__update__'] = create_update_string(tableName, mappings, fields, primaryKey)
+        attrs['__updates__'] = {}  # 只更新部分列的update语句，按列的组合缓存
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        new_cls = type.__new__(cls, name, bases, attrs)
+        if counter:
+            _counters[tableName] = (new_cls, attrs['__rowcounter__'])
+        # 声明了__write_behind__的表，enqueue()的行先进队列再批量写入
+        write_behind = attrs.get('__write_behind__', None)
+        new_cls.__writequeue__ = WriteQueue(new_cls, **write_behind) if write_behind else None
+        if write_behind:
+            _write_queues[tableName] = new_cls.__writequeue__
+        if archive:
+            _archives[tableName] = (new_cls, new_cls.__archive__)
+        # 声明了__count_in__的表，插入删除时维护父表上的计数列
+        for fk, (parent, field) in new_cls.__count_in__.items():
+            if fk not in mappings or field not in parent.__fields__:
+                raise RuntimeError('Invalid count column: %s => %s.%s' % (fk, parent.__name__, field))
+            _parent_counts.append((new_cls, fk, parent, field))
+        return new_cls
 
 
 # orm的基类model
@@ -163,16 +1188,47 @@ class Model(dict, metaclass=ModelMetaclass):
 
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
+        # 从数据库加载后修改过的属性名，None表示不是从数据库加载的，update时写所有已有的列
+        self.__dict__['__dirty__'] = None
 
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
+            if key in self.__deferred__:
+                raise AttributeError(r"'Model' deferred attribute '%s' is not loaded, call loadDeferred() first" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
         self[key] = value
 
+    # obj.key = value和obj['key'] = value都记录修改过的属性，内部写入不算修改时直接用dict.__setitem__
+    def __setitem__(self, key, value):
+        dirty = self.__dict__['__dirty__']
+        if dirty is not None and key in self.__mappings__ and (key not in self or self[key] != value):
+            dirty.add(key)
+        dict.__setitem__(self, key, value)
+
+    # dict.update被异步的update()方法覆盖了，dict的其他写入方法里只有setdefault会绕过__setitem__
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    # 用查询结果创建对象，没有修改过的属性
+    @classmethod
+    def fromRow(cls, row):
+        obj = cls(**row)
+        obj.__dict__['__dirty__'] = set()
+        return obj
+
+    # 修改过还没写回数据库的属性名
+    def dirtyFields(self):
+        dirty = self.__dict__['__dirty__']
+        if dirty is None:
+            return [f for f in self.__fields__ if f in self]
+        return [f for f in self.__fields__ if f in dirty]
+
     def getValue(self, key):
         return getattr(self, key, None)
 
@@ -188,18 +1244,74 @@ class Model(dict, metaclass=ModelMetaclass):
 
 
 
-    @classmethod # 把类中的方法声明为类方法
-    # 查找多条记录
-    async def findAll(cls, where=None, args=None, **kw):
-        ' find objects by where clause. '
-        sql = [cls.__select__]
+    # 生成只查询部分列的select语句，fields为None时使用默认的列，table为归档表时查询归档表
+    @classmethod
+    def selectOf(cls, fields=None, deferred=False, table=None):
+        if table is not None and table != cls.__table__:
+            return create_select_string(table, cls.__primary_key__, cls.columnsOf(fields, deferred)[1:])
+        if fields is None:
+            return cls.__select__ if deferred else cls.__select_list__
+        return create_select_string(cls.__table__, cls.__primary_key__, cls.columnsOf(fields)[1:])
+
+    # 查询要访问的表，有归档表并且查询范围可能包含归档的行时加上归档表
+    # 结果按归档列升序排列时先查归档表，否则先查主表
+    @classmethod
+    def tablesOf(cls, since=None, orderBy=None):
+        archive = cls.__archive__
+        if archive is None or not archive.touches(since):
+            return [cls.__table__]
+        first = (orderBy or '').split(',')[0].split()
+        if first and first[0].strip('`') == archive.column and (len(first) == 1 or first[1].lower() == 'asc'):
+            return [archive.table, cls.__table__]
+        return [cls.__table__, archive.table]
+
+    # select语句查询的列，主键在第一列
+    @classmethod
+    def columnsOf(cls, fields=None, deferred=False):
+        if fields is None:
+            return [cls.__primary_key__] + [f for f in cls.__fields__ if deferred or f not in cls.__deferred__]
+        for f in fields:
+            if f not in cls.__fields__:
+                raise ValueError('Invalid field for %s: %s' % (cls.__name__, f))
+        return [cls.__primary_key__] + [f for f in cls.__fields__ if f in fields]
+
+    # 生成对象对应的翻页游标
+    @classmethod
+    def cursorOf(cls, obj):
+        return encode_cursor([getattr(obj, k) for k in cls.__cursor__])
+
+    @classmethod
+    # 拼接查询条件，返回where、参数列表和排序，buildSelect和统计归档查询的行数共用
+    # since为归档列（没有归档表时为created_at）的下限，用来过滤和决定是否要查归档表
+    def buildWhere(cls, where=None, args=None, **kw):
+        # 复制一份参数，分表查询时同一个args要用多次
+        args = [] if args is None else list(args)
+        orderBy = kw.get('orderBy', None)       # 获取kw里的orderby查询条件
+        # 传了after参数就是游标翻页模式，不再用offset跳过前面的行
+        if 'after' in kw:
+            after = kw['after']
+            if after is not None:
+                values = decode_cursor(after, len(cls.__cursor__))
+                keyset, keyset_args = create_keyset_string(cls.__cursor__, values)
+                where = '(%s) and %s' % (where, keyset) if where else keyset
+                args = list(args) + keyset_args
+            orderBy = ', '.join('`%s` desc' % k for k in cls.__cursor__)
+        since = kw.get('since', None)
+        if since is not None:
+            column = cls.__archive__.column if cls.__archive__ is not None else 'created_at'
+            where = '(%s) and `%s`>=?' % (where, column) if where else '`%s`>=?' % column
+            args = list(args) + [since]
+        return where, args, orderBy
+
+    @classmethod
+    # 拼接查询语句，返回sql和参数列表，findAll和iterate共用，table为要查询的主表或归档表
+    def buildSelect(cls, where=None, args=None, **kw):
+        sql = [cls.selectOf(kw.get('fields', None), table=kw.get('table', None))]
+        where, args, orderBy = cls.buildWhere(where, args, **kw)
         # 如果where查询条件存在
         if where:
             sql.append('where')     # 添加where关键字
             sql.append(where)       # 拼接where查询条件
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)       # 获取kw里的orderby查询条件
         if orderBy:                             # 如果存在orderby
             sql.append('order by')              # 拼接orderby字符串
             sql.append(orderBy)                 # 拼接orderby查询条件
@@ -214,34 +1326,272 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)              # 将limit添加进参数列表
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)      # 将args参数列表注入sql语句之后，传递给select函数进行查询并返回查询结果
-        return [cls(**r) for r in rs]
+        return ' '.join(sql), args
+
+    @classmethod # 把类中的方法声明为类方法
+    # 查找多条记录，有归档表时先查一张表，limit没取够再接着查另一张表
+    async def findAll(cls, where=None, args=None, **kw):
+        ' find objects by where clause. '
+        tables = cls.tablesOf(kw.get('since', None), None if 'after' in kw else kw.get('orderBy', None))
+        if len(tables) == 1:
+            return await cls.findInTable(tables[0], where, args, **kw)
+        limit = kw.get('limit', None)
+        if limit is None:
+            offset, count = 0, None
+        elif isinstance(limit, int):
+            offset, count = 0, limit
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            offset, count = limit
+        else:
+            raise ValueError('Invalid limit value: %s' % str(limit))
+        objs = []
+        for i, table in enumerate(tables):
+            if count is not None:
+                kw['limit'] = (offset, count - len(objs))
+            part = await cls.findInTable(table, where, args, **kw)
+            objs.extend(part)
+            if count is not None and len(objs) >= count:
+                break
+            # 一行都没取到时offset可能超过了这张表的行数，减去这张表满足条件的行数再查下一张表
+            if part or offset == 0:
+                offset = 0
+            elif i < len(tables) - 1:
+                offset = max(0, offset - await cls.countInTable(table, where, args, **kw))
+        return objs
+
+    # 在主表或归档表里查找
+    @classmethod
+    async def findInTable(cls, table, where=None, args=None, **kw):
+        kw['table'] = table
+        sql, args = cls.buildSelect(where, args, **kw)
+        # compact为True时返回紧凑的行对象，适合只读的大列表
+        if kw.get('compact', False):
+            rs = await select(sql, args, tuples=True)
+            return cls.__row__.hydrate(cls.columnsOf(kw.get('fields', None)), rs)
+        rs = await select(sql, args)      # 将args参数列表注入sql语句之后，传递给select函数进行查询并返回查询结果
+        objs = [cls.fromRow(r) for r in rs]
+        # 只有完整加载的对象才放进identity map
+        if _identity.get() is not None and kw.get('fields', None) is None and not cls.__deferred__:
+            for obj in objs:
+                identity_add(obj)
+        return objs
+
+    @classmethod
+    # 流式遍历查询结果，每次从服务端取batch行，用法：async for blog in Blog.iterate(...)
+    async def iterate(cls, where=None, args=None, batch=100, **kw):
+        ' iterate objects by where clause without loading all rows. '
+        for table in cls.tablesOf(kw.get('since', None), kw.get('orderBy', None)):
+            sql, args_table = cls.buildSelect(where, args, table=table, **kw)
+            async for rs in select_iter(sql, args_table, batch):
+                for r in rs:
+                    yield cls.fromRow(r)
+
+    # 统计主表或归档表里满足条件的行数
+    @classmethod
+    async def countInTable(cls, table, where=None, args=None, **kw):
+        where, args, orderBy = cls.buildWhere(where, args, **kw)
+        sql = 'select count(*) _num_ from `%s`' % table
+        if where:
+            sql = '%s where %s' % (sql, where)
+        rs = await select(sql, args, 1)
+        return rs[0]['_num_']
 
     @classmethod
     # 查询某个字段的数量
     async def findNumber(cls, selectField, where=None, args=None):
         ' find number by select and where. '
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
-        if len(rs) == 0:
-            return None
-        return rs[0]['_num_']
+        # 不带条件的count直接读计数器
+        counter = cls.__rowcounter__
+        if where is None and counter is not None and counter.value is not None:
+            if selectField.replace(' ', '').replace('`', '').lower() in ('count(*)', 'count(%s)' % cls.__primary_key__.lower()):
+                return counter.value
+        # 有归档表时count把两张表的结果加起来，其他统计只查主表
+        tables = cls.tablesOf() if selectField.replace(' ', '').lower().startswith('count(') else [cls.__table__]
+        num = None
+        for table in tables:
+            sql = ['select %s _num_ from `%s`' % (selectField, table)]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            rs = await select(' '.join(sql), args, 1)
+            if len(rs) == 0:
+                return None
+            num = rs[0]['_num_'] if num is None else num + rs[0]['_num_']
+        return num
+
+    # 查找满足条件的第一个对象，找不到返回None
+    @classmethod
+    async def find_one(cls, where=None, args=None, **kw):
+        ' find first object by where clause. '
+        kw['limit'] = 1
+        objs = await cls.findAll(where, args, **kw)
+        return objs[0] if objs else None
 
+    # 是否存在满足条件的行
+    @classmethod
+    async def exists(cls, where=None, args=None):
+        ' test whether any row matches the where clause. '
+        for table in cls.tablesOf():
+            sql = ['select 1 _exists_ from `%s`' % table]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            sql.append('limit 1')
+            rs = await select(' '.join(sql), args, 1, tuples=True)
+            if rs:
+                return True
+        return False
+
+    # 把url、cookie里的字符串主键转换成整数主键，转换不了返回None
+    @classmethod
+    def castPk(cls, pk):
+        if isinstance(pk, str) and isinstance(cls.__mappings__[cls.__primary_key__], IntegerField):
+            try:
+                return int(pk)
+            except ValueError:
+                return None
+        return pk
 
     # 通过主键查找
     @classmethod
-    async def find(cls, pk):
+    async def find(cls, pk, fields=None):
         ' find object by primary key. '
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
+        pk = cls.castPk(pk)
+        if pk is None:
+            return None
+        imap = _identity.get()
+        if fields is None and imap is not None:
+            obj = imap.get((cls, pk))
+            if obj is not None:
+                return obj
+        # 事务里不读写行缓存，避免缓存没提交的数据
+        # 刚写过数据的会话不读缓存，缓存里可能是落后的副本读到的旧数据；只有从主库读到的行才放进缓存
+        cache = cls.__rowcache__ if fields is None and _tx_conn.get() is None else None
+        fill = cache is not None and reads_primary()
+        version = cache.version if cache is not None else None
+        row = cache.get(pk) if cache is not None and not session_sticky() else None
+        if row is None:
+            rs = await select('%s where `%s`=?' % (cls.selectOf(fields, True), cls.__primary_key__), [pk], 1)
+            # 主表里没有时再查归档表
+            if len(rs) == 0 and cls.__archive__ is not None:
+                rs = await select('%s where `%s`=?' % (cls.selectOf(fields, True, cls.__archive__.table), cls.__primary_key__), [pk], 1)
+            if len(rs) == 0:
+                return None
+            row = rs[0]
+            if fill:
+                cache.put(pk, dict(row), version)
+        obj = cls.fromRow(row)
+        if fields is None:
+            identity_add(obj, True)
+        return obj
+
+    # 按一组主键查找，结果和pks顺序相同，找不到的是None
+    @classmethod
+    async def find_many(cls, pks, chunk=500):
+        ' find objects by primary keys. '
+        imap = _identity.get()
+        cache = cls.__rowcache__ if _tx_conn.get() is None else None
+        # 和find一样，刚写过数据的会话不读缓存，只缓存主库读到的行
+        fill = cache is not None and reads_primary()
+        version = cls.__rowcache__.version if fill else None
+        if cache is not None and session_sticky():
+            cache = None
+        pks = [cls.castPk(pk) for pk in pks]
+        found = {}
+        missing, seen = [], set([None])
+        for pk in pks:
+            if pk in seen:
+                continue
+            seen.add(pk)
+            obj = imap.get((cls, pk)) if imap is not None else None
+            if obj is None and cache is not None:
+                row = cache.get(pk)
+                if row is not None:
+                    obj = cls.fromRow(row)
+                    identity_add(obj, True)
+            if obj is None:
+                missing.append(pk)
+            else:
+                found[pk] = obj
+        # 主表里没找到的再查归档表
+        for table in cls.tablesOf():
+            missing = [pk for pk in missing if pk not in found]
+            for i in range(0, len(missing), chunk):
+                part = missing[i:i + chunk]
+                rs = await select('%s where `%s` in (%s)' % (cls.selectOf(None, True, table), cls.__primary_key__, create_args_string(len(part))), part)
+                for row in rs:
+                    pk = row[cls.__primary_key__]
+                    if fill:
+                        cls.__rowcache__.put(pk, dict(row), version)
+                    obj = found[pk] = cls.fromRow(row)
+                    identity_add(obj, True)
+        return [found.get(pk) for pk in pks]
+
+    # 按主键查找，同一个请求里同时发出的调用合并成一次find_many，用法和find相同
+    @classmethod
+    async def find_batched(cls, pk):
+        loaders = _loaders.get()
+        if loaders is None or _tx_conn.get() is not None:
+            return await cls.find(pk)
+        pk = cls.castPk(pk)
+        if pk is None:
             return None
-        return cls(**rs[0])
+        imap = _identity.get()
+        obj = imap.get((cls, pk)) if imap is not None else None
+        if obj is not None:
+            return obj
+        loader = loaders.get(cls)
+        if loader is None:
+            loader = loaders[cls] = BatchLoader(cls)
+        return await loader.load(pk)
+
+    # 原子地增减一个计数列，不用先读出来再写回，identity map里的对象同步修改
+    @classmethod
+    async def increment(cls, pk, field, delta=1):
+        if field not in cls.__fields__:
+            raise ValueError('Invalid field for %s: %s' % (cls.__name__, field))
+        column = cls.__mappings__[field].name or field
+        rows = await execute('update `%s` set `%s`=`%s`+? where `%s`=?' % (cls.__table__, column, column, cls.__primary_key__), [delta, pk])
+        cls.invalidate(pk)
+        imap = _identity.get()
+        obj = imap.get((cls, pk)) if imap is not None else None
+        if obj is not None:
+            dict.__setitem__(obj, field, obj.get(field, 0) + delta)
+        return rows
+
+    # 让行缓存里的这些主键失效
+    @classmethod
+    def invalidate(cls, *pks):
+        if cls.__rowcache__ is not None:
+            pending = _tx_invalidations.get()
+            for pk in pks:
+                cls.__rowcache__.discard(pk)
+                if pending is not None:
+                    pending.append((cls, pk))
+
+    # 查询行缓存的统计
+    @classmethod
+    def cacheStats(cls):
+        return cls.__rowcache__.stats() if cls.__rowcache__ is not None else None
+
+    # 加载延迟加载的列，不传names就加载所有还没加载的
+    async def loadDeferred(self, *names):
+        names = [f for f in (names or self.__deferred__) if f not in self]
+        if not names:
+            return self
+        rs = await select('%s where `%s`=?' % (self.selectOf(names), self.__primary_key__), [self.getValue(self.__primary_key__)], 1)
+        if len(rs) == 0:
+            raise ValueError('Record not found: %s' % self.getValue(self.__primary_key__))
+        for f in names:
+            dict.__setitem__(self, f, rs[0][f])
+        return self
 
     # 保存实例到数据库
     async def save(self):
+        # 要维护父表计数的表，插入和改计数放在同一个事务里
+        if self.__count_in__ and _tx_conn.get() is None:
+            async with transaction():
+                return await self.save()
         # 将__fields__保存的除主键外的所有属性一次传递到getValueOrDefault函数中获取值
         args = list(map(self.getValueOrDefault, self.__fields__))
         # 获取主键值
@@ -250,19 +1600,169 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = await execute(self.__insert__, args)
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
+        else:
+            self.__dict__['__dirty__'] = set()
+            identity_add(self, True)
+            await count_in_parents(self.__class__, [self], 1)
+        count_delta(self.__rowcounter__, rows)
+
+    # 插入，主键或唯一索引冲突时什么都不做，返回插入的行数，0表示已经存在
+    async def insert_ignore(self):
+        if self.__count_in__ and _tx_conn.get() is None:
+            async with transaction():
+                return await self.insert_ignore()
+        args = list(map(self.getValueOrDefault, self.__fields__))
+        args.append(self.getValueOrDefault(self.__primary_key__))
+        rows = await execute(self.__insert_ignore__, args)
+        if rows == 1:
+            self.__dict__['__dirty__'] = set()
+            identity_add(self, True)
+            await count_in_parents(self.__class__, [self], 1)
+        count_delta(self.__rowcounter__, rows)
+        return rows
+
+    # 插入，主键或唯一索引冲突时返回0，插入成功返回1
+    # 和insert_ignore不同，超长、类型不对等数据错误照常抛出，不会被MySQL变成警告后截断写入
+    async def insert_unique(self):
+        try:
+            await self.save()
+        except Exception as e:
+            if _backend.is_duplicate_key(e):
+                return 0
+            raise
+        return 1
+
+    # 插入，主键或唯一索引冲突时更新fields这些列，fields为None时更新所有非主键列
+    # 返回影响的行数，MySQL插入时为1，更新时为2，没有变化时为0
+    async def upsert(self, fields=None):
+        if self.__count_in__ and _tx_conn.get() is None:
+            async with transaction():
+                return await self.upsert(fields)
+        if fields is None:
+            sql = self.__upsert__
+        else:
+            sql = create_upsert_string(self.__insert__, self.__mappings__, fields)
+        args = list(map(self.getValueOrDefault, self.__fields__))
+        args.append(self.getValueOrDefault(self.__primary_key__))
+        rows = await execute(sql, args)
+        self.invalidate(args[-1])
+        # 更新时对象里的值不一定和数据库一致，从identity map里去掉
+        identity_discard(self.__class__, args[-1])
+        self.__dict__['__dirty__'] = set()
+        # SQLite插入和更新都返回1，计数器靠定期核对修正
+        count_delta(self.__rowcounter__, 1 if rows == 1 else 0)
+        if rows == 1:
+            await count_in_parents(self.__class__, [self], 1)
+        return rows
+
+    # 放进写入队列，返回写入数据库后完成的future；没有声明__write_behind__或在事务里时直接save
+    async def enqueue(self):
+        queue = self.__writequeue__
+        if queue is None or _tx_conn.get() is not None:
+            await self.save()
+            fut = asyncio.get_event_loop().create_future()
+            fut.set_result(self)
+            return fut
+        return await queue.put(self)
+
+    # 生成只更新部分列的update语句
+    @classmethod
+    def updateOf(cls, fields):
+        fields = tuple(fields)
+        if len(fields) == len(cls.__fields__):
+            return cls.__update__
+        sql = cls.__updates__.get(fields, None)
+        if sql is None:
+            sql = cls.__updates__[fields] = create_update_string(cls.__table__, cls.__mappings__, fields, cls.__primary_key__)
+        return sql
 
     # 更新数据库数据
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        # 从数据库加载的对象只更新修改过的列，没有修改就不用访问数据库
+        # 其他对象只更新已有的列，避免把没查出来的列写成NULL
+        fields = self.dirtyFields()
+        if not fields:
+            return
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(self.updateOf(fields), args)
+        # 主表里没有时可能已经归档了
+        if rows == 0 and self.__archive__ is not None:
+            rows = await execute(create_update_string(self.__archive__.table, self.__mappings__, fields, self.__primary_key__), args)
+        self.invalidate(args[-1])
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
+        self.__dict__['__dirty__'] = set()
+        # 部分加载的对象不能放进identity map，原来放进去的也已经过期了
+        if all(f in self for f in self.__fields__):
+            identity_add(self, True)
+        else:
+            identity_discard(self.__class__, self.getValue(self.__primary_key__))
+
+    # 批量插入，每chunk行拼成一条多行insert语句，返回每批影响的行数
+    @classmethod
+    async def save_many(cls, rows, chunk=500):
+        if cls.__count_in__ and _tx_conn.get() is None:
+            async with transaction():
+                return await cls.save_many(rows, chunk)
+        rows = [r if isinstance(r, cls) else cls(**r) for r in rows]
+        values = cls.__insert__.rpartition(' values ')[2]
+        counts = []
+        for i in range(0, len(rows), chunk):
+            part = rows[i:i + chunk]
+            args = []
+            for r in part:
+                args.extend(map(r.getValueOrDefault, cls.__fields__))
+                args.append(r.getValueOrDefault(cls.__primary_key__))
+            sql = cls.__insert__ + (', ' + values) * (len(part) - 1)
+            rows_affected = await execute(sql, args)
+            if rows_affected != len(part):
+                logging.warn('failed to insert records: affected rows: %s of %s' % (rows_affected, len(part)))
+            count_delta(cls.__rowcounter__, rows_affected)
+            if rows_affected == len(part):
+                await count_in_parents(cls, part, 1)
+            counts.append(rows_affected)
+        return counts
+
+    # 批量按主键更新，要写的列相同的行用executemany一起执行，返回每批影响的行数
+    @classmethod
+    async def update_many(cls, rows, chunk=500):
+        groups = {}
+        for r in rows:
+            fields = tuple(r.dirtyFields() if isinstance(r, cls) else (f for f in cls.__fields__ if f in r))
+            if fields:
+                groups.setdefault(fields, []).append(r)
+        counts = []
+        for fields, part_rows in groups.items():
+            sql = cls.updateOf(fields)
+            for i in range(0, len(part_rows), chunk):
+                part = part_rows[i:i + chunk]
+                args = [[r.get(f) for f in fields] + [r.get(cls.__primary_key__)] for r in part]
+                counts.append(await executemany(sql, args))
+                cls.invalidate(*[a[-1] for a in args])
+                for r in part:
+                    if isinstance(r, cls):
+                        r.__dict__['__dirty__'] = set()
+                    if isinstance(r, cls) and all(f in r for f in cls.__fields__):
+                        identity_add(r, True)
+                    else:
+                        identity_discard(cls, r.get(cls.__primary_key__))
+        return counts
 
     # 删除数据
     async def remove(self):
+        if self.__count_in__ and _tx_conn.get() is None:
+            async with transaction():
+                return await self.remove()
         args = [self.getValue(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
+        if rows == 0 and self.__archive__ is not None:
+            rows = await execute('delete from `%s` where `%s`=?' % (self.__archive__.table, self.__primary_key__), args)
+        self.invalidate(args[0])
+        count_delta(self.__rowcounter__, -rows)
+        if rows == 1:
+            await count_in_parents(self.__class__, [self], -1)
+        identity_discard(self.__class__, args[0])
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
 
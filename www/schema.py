@@ -0,0 +1,33 @@
+'''
+Generate the schema from the models, or diff / apply it against the configured database.
+
+    python schema.py            print CREATE TABLE statements for all models
+    python schema.py --diff     print the tables and indexes missing from the database
+    python schema.py --apply    create the missing tables and indexes
+'''
+
+import sys, asyncio, logging
+
+import orm
+from config import configs
+from models import User, Blog, Comment
+
+MODELS = (User, Blog, Comment)
+
+async def main(argv):
+    if '--diff' not in argv and '--apply' not in argv:
+        for cls in MODELS:
+            print('%s;\n' % orm.create_table_sql(cls))
+        return
+    await orm.create_pool(loop=None, **configs.db)
+    if '--apply' in argv:
+        statements = await orm.apply_schema(*MODELS)
+    else:
+        statements = await orm.diff_schema(*MODELS)
+    for sql in statements:
+        print('%s;' % sql)
+    logging.info('%s statements %s.' % (len(statements), 'applied' if '--apply' in argv else 'pending'))
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(sys.argv[1:]))
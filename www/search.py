@@ -0,0 +1,239 @@
+'''
+Full-text search over blogs.
+
+An in-memory inverted index over Blog.name, summary and content. CJK text
+is indexed as single characters and overlapping bigrams, other text as
+lowercase words, and results are ranked with BM25. The blog handlers update
+the index incrementally. The index is saved to disk as zlib-compressed JSON
+together with a fingerprint of the blogs table. Startup rebuilds it when the
+file is missing, the fingerprint differs, or the index was modified after the
+last save.
+'''
+
+import os, re, math, json, zlib, time, asyncio, logging
+
+import ids
+from models import Blog
+
+# 中日韩文字按相邻两个字切分，其他文字按单词切分
+# 建索引时unigrams为True，再加上单个字，只有一个字的查询也能匹配；查询时多个字只用两字词，结果更准确
+_CJK = r'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_RE_TOKEN = re.compile(r'[%s]+|[0-9a-z]+' % _CJK)
+_RE_CJK = re.compile(r'[%s]' % _CJK)
+
+def tokenize(text, unigrams=False):
+    '''
+    Split text into search terms.
+    >>> tokenize('Python异步编程')
+    ['python', '异步', '步编', '编程']
+    >>> tokenize('写 Blog')
+    ['写', 'blog']
+    >>> tokenize('博客', unigrams=True)
+    ['博', '客', '博客']
+    '''
+    tokens = []
+    for run in _RE_TOKEN.findall(text.lower()):
+        if len(run) > 1 and _RE_CJK.match(run):
+            if unigrams:
+                tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+# 各字段的权重，标题里出现的词比正文里的更重要
+FIELDS = (('name', 3), ('summary', 2), ('content', 1))
+
+class SearchIndex(object):
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {} # 词 => {文档id: 加权词频}
+        self.lengths = {} # 文档id => 加权长度
+        self.terms = {} # 文档id => 包含的词，删除文档时用
+        self.total_length = 0
+        self.fingerprint = None # 保存时博客表的指纹，见blog_fingerprint()
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, doc_id, **fields):
+        self.remove(doc_id)
+        freqs = {}
+        for name, weight in FIELDS:
+            for term in tokenize(fields.get(name, None) or '', unigrams=True):
+                freqs[term] = freqs.get(term, 0) + weight
+        length = sum(freqs.values())
+        for term, tf in freqs.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        self.lengths[doc_id] = length
+        self.terms[doc_id] = list(freqs)
+        self.total_length += length
+        self.dirty = True
+
+    def remove(self, doc_id):
+        length = self.lengths.pop(doc_id, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for term in self.terms.pop(doc_id):
+            docs = self.postings[term]
+            del docs[doc_id]
+            if not docs:
+                del self.postings[term]
+        self.dirty = True
+
+    # 按BM25排序，返回[(文档id, 分数)]
+    def search(self, query):
+        n = len(self.lengths)
+        if n == 0:
+            return []
+        avgdl = self.total_length / n or 1
+        scores = {}
+        for term in set(tokenize(query)):
+            docs = self.postings.get(term, None)
+            if not docs:
+                continue
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_id, tf in docs.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / avgdl)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], str(item[0])))
+
+    # 复制一份索引，在线程池里保存时事件循环可以继续修改原来的索引
+    def snapshot(self):
+        index = SearchIndex(self.k1, self.b)
+        index.postings = dict((term, dict(docs)) for term, docs in self.postings.items())
+        index.lengths = dict(self.lengths)
+        index.total_length = self.total_length
+        index.fingerprint = self.fingerprint
+        return index
+
+    # 保存为压缩的JSON，文档id换成序号，倒排表写成[序号, 词频, 序号, 词频, ...]
+    def dumps(self):
+        doc_ids = list(self.lengths)
+        offsets = dict((doc_id, i) for i, doc_id in enumerate(doc_ids))
+        data = dict(version=2, fingerprint=self.fingerprint, docs=[[doc_id, self.lengths[doc_id]] for doc_id in doc_ids],
+                    postings=dict((term, [x for doc_id, tf in docs.items() for x in (offsets[doc_id], tf)])
+                                  for term, docs in self.postings.items()))
+        return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    def loads(self, blob):
+        data = json.loads(zlib.decompress(blob).decode('utf-8'))
+        if data.get('version', None) != 2:
+            raise ValueError('Unsupported search index version: %s' % data.get('version', None))
+        self.fingerprint = data['fingerprint']
+        doc_ids = [doc_id for doc_id, length in data['docs']]
+        self.lengths = dict((doc_id, length) for doc_id, length in data['docs'])
+        self.total_length = sum(self.lengths.values())
+        self.postings = dict((term, dict((doc_ids[flat[i]], flat[i + 1]) for i in range(0, len(flat), 2)))
+                             for term, flat in data['postings'].items())
+        self.terms = dict((doc_id, []) for doc_id in doc_ids)
+        for term, docs in self.postings.items():
+            for doc_id in docs:
+                self.terms[doc_id].append(term)
+        self.dirty = False
+
+_index = SearchIndex()
+_path = None
+_changes = 0 # 索引的修改次数，保存时用来判断保存期间有没有新的修改
+_stale = False # 索引文件旁边是否有.stale标记
+
+# 保存后第一次修改索引时在索引文件旁边放一个标记，保存前进程退出的话，下次启动看到标记就重建
+def _changed():
+    global _changes, _stale
+    _changes += 1
+    if _path is not None and not _stale:
+        open('%s.stale' % _path, 'w').close()
+        _stale = True
+
+def index_blog(blog):
+    _index.add(blog.id, name=blog.name, summary=blog.summary, content=blog.content)
+    _changed()
+
+def unindex_blog(blog_id):
+    _index.remove(Blog.castPk(blog_id))
+    _changed()
+
+# 搜索博客，返回按分数排序的[(博客id, 分数)]
+def search(query):
+    return _index.search(query)
+
+# 博客表的指纹：id生成方式、博客数和最大的id，迁移id或者索引以外有增删时和保存的索引对不上
+async def blog_fingerprint():
+    return [type(ids.generator()).__name__, await Blog.findNumber('count(id)'), await Blog.findNumber('max(id)')]
+
+# 写到临时文件再改名，保存到一半时退出不会留下损坏的文件
+def _write(path, index):
+    tmp = '%s.tmp' % path
+    with open(tmp, 'wb') as f:
+        f.write(index.dumps())
+    os.replace(tmp, path)
+
+# 先取指纹再复制索引，之间新增的博客会让指纹对不上而重建，不会漏掉
+# 编码、压缩和写文件在线程池里执行，不阻塞事件循环
+async def save_index():
+    global _stale
+    if _path is None or not _index.dirty:
+        return
+    fingerprint = await blog_fingerprint()
+    _index.fingerprint = fingerprint
+    index, changes = _index.snapshot(), _changes
+    _index.dirty = False
+    try:
+        await asyncio.get_event_loop().run_in_executor(None, _write, _path, index)
+    except BaseException:
+        _index.dirty = True
+        raise
+    # 保存期间没有新的修改才去掉标记
+    if changes == _changes and _stale:
+        os.remove('%s.stale' % _path)
+        _stale = False
+    logging.info('search index saved: %s docs' % len(index))
+
+async def rebuild_index():
+    index = SearchIndex()
+    async for blog in Blog.iterate(fields=('name', 'summary', 'content'), batch=200):
+        index.add(blog.id, name=blog.name, summary=blog.summary, content=blog.content)
+    return index
+
+# 启动时加载索引文件，文件不存在、损坏、有修改后没保存的标记或者指纹和博客表对不上时重建
+async def init_index(path):
+    global _index, _path, _stale
+    _path = path
+    _stale = os.path.exists('%s.stale' % path)
+    index = SearchIndex()
+    try:
+        with open(path, 'rb') as f:
+            index.loads(f.read())
+    except FileNotFoundError:
+        logging.info('search index not found: %s' % path)
+    except (ValueError, KeyError, zlib.error) as e:
+        logging.warning('invalid search index %s: %s' % (path, e))
+    fingerprint = await blog_fingerprint()
+    if _stale or index.fingerprint != fingerprint:
+        logging.info('rebuild search index: %s, fingerprint %s, expected %s' % (
+            'modified after last save' if _stale else 'out of date', index.fingerprint, fingerprint))
+        started = time.time()
+        index = await rebuild_index()
+        index.dirty = True
+        logging.info('search index rebuilt in %.1fs' % (time.time() - started))
+    _index = index
+    await save_index()
+
+# 后台定期保存修改过的索引
+def start_index_saver(interval=60):
+    async def loop():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await save_index()
+            except Exception as e:
+                logging.exception(e)
+    return asyncio.ensure_future(loop())
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,272 @@
+'''
+In-process SQLite backend for orm, a stand-in for aiomysql on build boxes.
+
+sqlite3 calls run in a thread pool. The pool, connection and cursor
+objects expose the parts of the aiomysql interface that orm uses.
+'''
+
+import asyncio, sqlite3, re, os, itertools, functools, logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+# 游标类型，和aiomysql的Cursor、DictCursor、SSDictCursor对应
+class Cursor(object):
+    dict_rows = False
+
+class DictCursor(Cursor):
+    dict_rows = True
+
+class SSDictCursor(DictCursor):
+    pass
+
+# 把orm生成的MySQL语法转换成SQLite语法，?占位符两边通用
+_RE_INSERT_IGNORE = re.compile(r'^\s*insert\s+ignore\s+into\s', re.I)
+_RE_ON_DUPLICATE = re.compile(r'\s+on\s+duplicate\s+key\s+update\s+', re.I)
+_RE_VALUES_FUNC = re.compile(r'values\(\s*("[^"]+"|\w+)\s*\)', re.I)
+_RE_CREATE_INDEX = re.compile(r'^(\s*create\s+(?:unique\s+)?index\s+(?:if\s+not\s+exists\s+)?)"(\w+)"(\s+on\s+)"(\w+)"', re.I)
+
+def translate(sql):
+    sql = sql.replace('`', '"')
+    # SQLite的索引名是整个库唯一的，加上表名前缀
+    sql = _RE_CREATE_INDEX.sub(lambda m: '%s"%s_%s"%s"%s"' % (m.group(1), m.group(4), m.group(2), m.group(3), m.group(4)), sql)
+    sql = _RE_INSERT_IGNORE.sub('insert or ignore into ', sql)
+    m = _RE_ON_DUPLICATE.search(sql)
+    if m:
+        head, tail = sql[:m.start()], sql[m.end():]
+        sql = '%s on conflict do update set %s' % (head, _RE_VALUES_FUNC.sub(r'excluded.\1', tail))
+    return sql
+
+# 把schema.sql里的MySQL建表语句转换成SQLite能执行的语句
+_RE_SKIP = re.compile(r'^(drop\s+database|create\s+database|use|grant)\b', re.I)
+_RE_TABLE = re.compile(r'^create\s+table\s+`?(\w+)`?\s*\((.*)\)[^)]*$', re.I | re.S)
+_RE_KEY = re.compile(r'^(unique\s+)?(?:key|index)\s+`?(\w+)`?\s*\((.*)\)$', re.I | re.S)
+
+def _split_items(body):
+    items, depth, start = [], 0, 0
+    for i, c in enumerate(body):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            items.append(body[start:i].strip())
+            start = i + 1
+    items.append(body[start:].strip())
+    return [item for item in items if item]
+
+EXPLAIN = 'explain query plan '
+# SQLite只能整理整个库，不用表名
+COMPACT = 'vacuum'
+
+# 查询现有的表和索引，和MySQL的information_schema查询返回相同的列
+TABLE_QUERY = "select name table_name from sqlite_master where type = 'table'"
+COLUMN_QUERY = 'select name column_name from pragma_table_info(?)'
+INDEX_QUERY = "select il.name index_name, ii.name column_name, not il.\"unique\" non_unique from pragma_index_list(?) il join pragma_index_info(il.name) ii where il.origin = 'c' order by il.name, ii.seqno"
+
+# 拆分建表sql，表定义里的key写法拆成单独的create index语句，返回的语句还要经过translate()
+def split_ddl(text):
+    text = '\n'.join(line.split('--', 1)[0] for line in text.splitlines())
+    statements = []
+    for stmt in text.split(';'):
+        stmt = stmt.strip()
+        if not stmt or _RE_SKIP.match(stmt):
+            continue
+        m = _RE_TABLE.match(stmt)
+        if m is None:
+            statements.append(stmt)
+            continue
+        table, columns, indexes = m.group(1), [], []
+        for item in _split_items(m.group(2)):
+            k = _RE_KEY.match(item)
+            if k is None:
+                columns.append(item)
+                continue
+            indexes.append('create %sindex if not exists `%s` on `%s` (%s)' % (
+                'unique ' if k.group(1) else '', k.group(2), table, k.group(3)))
+        statements.append('create table if not exists `%s` (\n    %s\n)' % (table, ',\n    '.join(columns)))
+        statements.extend(indexes)
+    return statements
+
+def translate_ddl(text):
+    return [translate(sql) for sql in split_ddl(text)]
+
+# 是否主键或唯一索引冲突的错误
+def is_duplicate_key(e):
+    return isinstance(e, sqlite3.IntegrityError) and ('UNIQUE constraint failed' in str(e) or 'PRIMARY KEY' in str(e))
+
+
+class SQLiteCursor(object):
+
+    def __init__(self, conn, cursor_type):
+        self._conn = conn
+        self._dict_rows = cursor_type.dict_rows
+        self._cur = None
+        self.description = None
+        self.rowcount = -1
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._cur is not None:
+            cur, self._cur = self._cur, None
+            await self._conn._run(cur.close)
+
+    def _convert(self, rows):
+        if not self._dict_rows:
+            return [tuple(r) for r in rows]
+        names = [d[0] for d in self.description]
+        return [dict(zip(names, r)) for r in rows]
+
+    async def execute(self, sql, args=()):
+        self._cur = await self._conn._run(self._conn._db.execute, sql, tuple(args or ()))
+        self.description = self._cur.description
+        self.rowcount = self._cur.rowcount
+
+    async def executemany(self, sql, args_list):
+        self._cur = await self._conn._run(self._conn._db.executemany, sql, [tuple(args) for args in args_list])
+        self.description = self._cur.description
+        self.rowcount = self._cur.rowcount
+
+    async def fetchone(self):
+        rs = await self.fetchmany(1)
+        return rs[0] if rs else None
+
+    async def fetchmany(self, size=1):
+        return self._convert(await self._conn._run(self._cur.fetchmany, size))
+
+    async def fetchall(self):
+        return self._convert(await self._conn._run(self._cur.fetchall))
+
+
+class SQLiteConnection(object):
+
+    def __init__(self, db, executor):
+        self._db = db
+        self._executor = executor
+
+    # 在线程池里执行sqlite3调用，共享缓存的内存库遇到表锁时稍等重试
+    async def _run(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        call = functools.partial(fn, *args)
+        for delay in itertools.chain((0.001, 0.005, 0.01, 0.05), itertools.repeat(0.1, 50)):
+            try:
+                return await loop.run_in_executor(self._executor, call)
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                await asyncio.sleep(delay)
+        return await loop.run_in_executor(self._executor, call)
+
+    def cursor(self, cursor_type=Cursor):
+        return SQLiteCursor(self, cursor_type)
+
+    async def begin(self):
+        await self._run(self._db.execute, 'begin')
+
+    async def commit(self):
+        if self._db.in_transaction:
+            await self._run(self._db.execute, 'commit')
+
+    async def rollback(self):
+        if self._db.in_transaction:
+            await self._run(self._db.execute, 'rollback')
+
+    def close(self):
+        self._db.close()
+
+
+class _PoolContext(object):
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self._pool.acquire()
+        return self._conn
+
+    async def __aexit__(self, *exc):
+        await self._pool.release(self._conn)
+
+
+class SQLitePool(object):
+
+    _memory_ids = itertools.count(1)
+
+    def __init__(self, database, minsize=1, maxsize=10):
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.size = 0
+        self._free = []
+        self._sem = asyncio.Semaphore(maxsize)
+        self._executor = ThreadPoolExecutor(max_workers=maxsize, thread_name_prefix='sqlite')
+        # 内存库用共享缓存让连接池里的连接看到同一个库，并保留一个连接防止库被释放
+        if database == ':memory:':
+            self._uri = 'file:orm-memory-%s?mode=memory&cache=shared' % next(self._memory_ids)
+            self._anchor = self._connect()
+        else:
+            self._uri = 'file:%s' % os.path.abspath(database)
+            self._anchor = None
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    def _connect(self):
+        db = sqlite3.connect(self._uri, uri=True, isolation_level=None, check_same_thread=False, timeout=30)
+        db.execute('pragma read_uncommitted = 1')
+        return db
+
+    def get(self):
+        return _PoolContext(self)
+
+    async def acquire(self):
+        await self._sem.acquire()
+        try:
+            if self._free:
+                return self._free.pop()
+            conn = SQLiteConnection(self._connect(), self._executor)
+            self.size += 1
+            return conn
+        except BaseException:
+            self._sem.release()
+            raise
+
+    async def release(self, conn):
+        try:
+            await conn.rollback()
+        finally:
+            self._free.append(conn)
+            self._sem.release()
+
+    # 执行建表语句，text为MySQL语法的schema
+    async def load_schema(self, text):
+        async with self.get() as conn:
+            for sql in translate_ddl(text):
+                await conn._run(conn._db.execute, sql)
+
+    def close(self):
+        for conn in self._free:
+            conn.close()
+        self._free = []
+        if self._anchor is not None:
+            self._anchor.close()
+            self._anchor = None
+        self._executor.shutdown(wait=False)
+
+    async def wait_closed(self):
+        pass
+
+# 创建连接池，db为数据库文件路径或':memory:'，schema为要执行的建表sql文件
+async def create_pool(loop=None, **kw):
+    pool = SQLitePool(kw.get('db', ':memory:'), kw.get('minsize', 1), kw.get('maxsize', 10))
+    schema = kw.get('schema', None)
+    if schema:
+        logging.info('load schema: %s' % schema)
+        with open(schema, encoding='utf-8') as f:
+            await pool.load_schema(f.read())
+    return pool
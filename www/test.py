@@ -1,16 +1,26 @@
+import os, sys
 import orm
 from models import User,Blog,Comment
+from config import configs
 import asyncio
 
 
 loop = asyncio.get_event_loop()
 
+# 默认用进程内的SQLite内存库，构建机上不需要MySQL；加--mysql参数时连接configs.db里配置的MySQL
+def db_config():
+    if '--mysql' in sys.argv:
+        return configs.db
+    return dict(backend='sqlite', db=':memory:', schema=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql'))
+
 async def test():
-    #创建连接池,里面的host,port,user,password需要替换为自己数据库的信息
-    await orm.create_pool(loop=loop,host='127.0.0.1', port=3306,user='root', password='admin',db='blog')
+    await orm.create_pool(loop=loop, **db_config())
     #没有设置默认值的一个都不能少
-    u = User(name='Test', email='test@gmail.com', passwd='1234567890', image='about:blank',id="123")
+    u = User(name='Test', email='test@gmail.com', passwd='1234567890', image='about:blank')
     await u.save()
+    found = await User.find(u.id)
+    assert found is not None and found.email == 'test@gmail.com', found
+    print('ok: %s' % found.id)
 
 #把协程丢到事件循环中执行
-loop.run_until_complete(test())
\ No newline at end of file
+loop.run_until_complete(test())
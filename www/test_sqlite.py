@@ -0,0 +1,219 @@
+'''
+Behaviour checks of orm.py against SQLite, no MySQL needed.
+
+    python test_sqlite.py            run all checks
+    python test_sqlite.py archive    run only checks whose name contains "archive"
+
+Each check gets a fresh database built from schema.sql, a file by default.
+File databases do not share a cache between connections, so a read on
+another connection only sees committed rows, like MySQL's default isolation
+level. Checks that need to write while another connection holds a read
+transaction use an in-memory database instead, where SQLite does not lock
+readers against writers.
+'''
+
+import os, sys, time, shutil, asyncio, logging, tempfile, contextvars
+
+# orm的info日志太多，只看检查结果
+logging.basicConfig(level=logging.WARNING)
+
+import orm
+from models import User, Blog, Comment
+
+MODELS = (User, Blog, Comment)
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+
+_checks = []
+
+# memory为True时用内存库，SQLite的文件库在读事务结束前不能提交别的连接的写入
+def check(memory=False):
+    def decorator(fn):
+        _checks.append((fn, memory))
+        return fn
+    return decorator
+
+def new_blog(**kw):
+    return Blog(**dict(dict(user_id='u', user_name='n', user_image='about:blank', name='b', summary='s', content='c'), **kw))
+
+def new_comment(blog, **kw):
+    return Comment(**dict(dict(blog_id=blog.id, user_id='u', user_name='n', user_image='about:blank', content='c'), **kw))
+
+# 在新的上下文里执行，不在当前的事务里，模拟并发的另一个请求
+def concurrently(coro):
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
+# 数据库里的评论数，绕过行缓存
+async def stored_count(blog):
+    Blog.invalidate(blog.id)
+    return (await Blog.find(blog.id)).comment_count
+
+# 回滚的事务不改计数器和父表计数，提交后才生效
+@check()
+async def check_transaction_counters():
+    b = new_blog()
+    await b.save()
+    counter = Comment.__rowcounter__
+    before = counter.value
+    try:
+        async with orm.transaction():
+            await new_comment(b).save()
+            raise RuntimeError('rollback')
+    except RuntimeError:
+        pass
+    assert counter.value == before, (counter.value, before)
+    assert await Comment.findNumber('count(id)') == 0
+    assert await stored_count(b) == 0
+    async with orm.transaction():
+        await new_comment(b).save()
+        assert counter.value == before
+    assert counter.value == before + 1, (counter.value, before)
+    assert await stored_count(b) == 1
+
+# 游标翻页和offset翻页跨过主表和归档表，不重复也不漏行
+@check()
+async def check_archive_paging():
+    b = new_blog()
+    await b.save()
+    now = time.time()
+    for i in range(7):
+        await new_comment(b, created_at=now - i * 30 * 86400).save()
+    assert await orm.archive_rows(Comment) == 4
+    expected = [c.id for c in await Comment.findInTable('comments', orderBy='`created_at` desc')] + \
+               [c.id for c in await Comment.findInTable('comments_archive', orderBy='`created_at` desc')]
+    assert len(expected) == 7
+    seen, after = [], None
+    while True:
+        page = await Comment.findAll(after=after, limit=2)
+        if not page:
+            break
+        seen.extend(c.id for c in page)
+        after = Comment.cursorOf(page[-1])
+    assert sorted(seen) == sorted(expected) and len(seen) == len(set(seen)), seen
+    page = await Comment.findAll(orderBy='`created_at` desc', limit=(2, 3))
+    assert [c.id for c in page] == expected[2:5], page
+    page = await Comment.findAll(orderBy='`created_at` desc', limit=(5, 10))
+    assert [c.id for c in page] == expected[5:], page
+    assert await Comment.findNumber('count(id)') == 7
+
+# 写入队列里一行写不进去时只有这一行失败，同一批的其他行照常写入
+@check()
+async def check_write_behind_failure():
+    b = new_blog()
+    await b.save()
+    futs = []
+    for i in range(5):
+        futs.append(await new_comment(b, content=None if i == 2 else 'c%s' % i).enqueue())
+    results = await asyncio.gather(*futs, return_exceptions=True)
+    failed = [i for i, r in enumerate(results) if isinstance(r, Exception)]
+    assert failed == [2], results
+    assert await Comment.findNumber('count(id)') == 4
+    assert await stored_count(b) == 4
+
+# insert_ignore、insert_unique遇到唯一索引冲突返回0，upsert更新已有的行
+@check()
+async def check_insert_conflicts():
+    u = User(name='a', email='a@example.com', passwd='x', image='about:blank')
+    assert await u.insert_ignore() == 1
+    dup = User(name='b', email='a@example.com', passwd='x', image='about:blank')
+    assert await dup.insert_ignore() == 0
+    dup = User(name='b', email='a@example.com', passwd='x', image='about:blank')
+    assert await dup.insert_unique() == 0
+    other = User(name='c', email='c@example.com', passwd='x', image='about:blank')
+    assert await other.insert_unique() == 1
+    try:
+        await User(id=other.id, name='c', email='c@example.com', passwd='x', image='about:blank').save()
+    except Exception as e:
+        assert orm._backend.is_duplicate_key(e), e
+    else:
+        raise AssertionError('duplicate save did not fail')
+    await User.find(u.id) # 放进行缓存
+    await User(id=u.id, name='renamed', email=u.email, passwd='x', image='about:blank').upsert(['name'])
+    assert (await User.find(u.id)).name == 'renamed'
+    await User(name='d', email='d@example.com', passwd='x', image='about:blank').upsert()
+    # SQLite的upsert插入和更新都返回1，计数器不准，直接查表
+    assert len(await User.findAll()) == 3
+
+# 按schema.sql建的库没有差异，删掉的索引和表能被补回来
+@check()
+async def check_diff_schema():
+    assert await orm.diff_schema(*MODELS) == []
+    index = [name for name, (columns, unique) in (await orm.table_indexes('comments')).items() if columns == ('blog_id', 'created_at')]
+    await orm.execute('drop index `%s`' % index[0], [])
+    await orm.execute('drop table `comments_archive`', [])
+    statements = await orm.diff_schema(*MODELS)
+    assert len(statements) == 2 and any('comments_archive' in s for s in statements), statements
+    assert await orm.apply_schema(*MODELS) == statements
+    assert await orm.diff_schema(*MODELS) == []
+
+# 核对评论数时并发插入的评论不能被覆盖掉
+@check(memory=True)
+async def check_reconcile_race():
+    b = new_blog()
+    await b.save()
+    for i in range(3):
+        await new_comment(b).save()
+    select = orm.select
+    inserted = []
+    async def racing_select(sql, args, *a, **kw):
+        rs = await select(sql, args, *a, **kw)
+        if 'group by' in sql and not inserted:
+            inserted.append(await concurrently(new_comment(b, content='race').save()))
+        return rs
+    orm.select = racing_select
+    try:
+        await orm.reconcile_parent_counts()
+    finally:
+        orm.select = select
+    assert inserted
+    assert await stored_count(b) == await Comment.findNumber('count(id)') == 4
+
+# 事务提交前被并发读放回缓存的旧行，提交后要再失效一次
+@check()
+async def check_cache_invalidation_race():
+    b = new_blog()
+    await b.save()
+    increment = Blog.increment.__func__
+    stale = []
+    async def racing_increment(cls, *args, **kw):
+        rows = await increment(cls, *args, **kw)
+        stale.append((await concurrently(Blog.find(b.id))).comment_count)
+        return rows
+    Blog.increment = classmethod(racing_increment)
+    try:
+        await new_comment(b).save()
+    finally:
+        Blog.increment = classmethod(increment)
+    assert stale == [0], stale
+    assert (await Blog.find(b.id)).comment_count == 1
+
+# 每个检查用一个新的库，清掉上一个库留下的行缓存
+async def setup(path):
+    await orm.create_pool(None, backend='sqlite', db=path, schema=SCHEMA)
+    for cls in MODELS:
+        if cls.__rowcache__ is not None:
+            cls.__rowcache__.clear()
+    await orm.init_counters()
+
+async def main(argv):
+    pattern = argv[0] if argv else None
+    tmp = tempfile.mkdtemp()
+    failed = 0
+    try:
+        for fn, memory in _checks:
+            if pattern and pattern not in fn.__name__:
+                continue
+            await setup(':memory:' if memory else os.path.join(tmp, '%s.db' % fn.__name__))
+            try:
+                await fn()
+            except Exception:
+                failed += 1
+                logging.exception('FAIL: %s' % fn.__name__)
+            else:
+                print('ok: %s' % fn.__name__)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return failed
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    sys.exit(1 if loop.run_until_complete(main(sys.argv[1:])) else 0)